@@ -0,0 +1,88 @@
+import faiss
+import math
+import os
+import numpy as np
+import numpy.typing as npt
+import pin_planner
+import probe_trace
+import utils
+
+# floor of the nearest centroid distance, a query sitting on its centroid would divide by zero
+MIN_DISTANCE = 1e-12
+
+def probe_counts(distances: npt.NDArray, ratio: float) -> npt.NDArray:
+    """ returns how many lists each query probes: its centroids (ascending distances, nq x max_nprobe)
+        up to ratio times the distance of its nearest one, at least one
+    """
+    nearest = np.maximum(distances[:, :1], MIN_DISTANCE)
+    return np.maximum((distances <= ratio * nearest).sum(axis=1), 1)
+
+def learn_probe_ratio(index, max_nprobe: int, recall_target: float) -> float:
+    """ learns the smallest ratio at which adaptive probing (up to max_nprobe) reaches recall_target recall@1
+        on the profiled xt queries, saved as a sidecar (inf when every query needs all max_nprobe lists)
+    """
+    path = index.sidecar_path(f'probe_ratio.nprobe{max_nprobe}.recall{recall_target}')
+    if not os.path.isfile(path):
+        print(f"Learning probe ratio {path}...")
+        queries = pin_planner.profile_queries(index)
+        distances, ranking = faiss.knn(queries, index.centroids, max_nprobe)
+        if np.shares_memory(index.xt, index.xb):
+            # GloVe has no training set, xt is xb and every profiled query is its own nearest neighbor
+            _, nn = faiss.knn(queries, index.xb, 2, metric=index.index_ivf.metric_type)
+            own = nn[:, 0] == np.arange(len(queries))
+            nn[own, 0] = nn[own, 1]
+        else:
+            _, nn = faiss.knn(queries, index.xb, 1, metric=index.index_ivf.metric_type)
+        nn_lists = index.index_ivf.quantizer.assign(index.xb[nn[:, 0]], 1).ravel()
+        probed = ranking == nn_lists[:, None]
+        found = probed.any(axis=1)
+        rank = probed.argmax(axis=1)
+        # ratio each query needs for its nn list to be probed
+        needed = np.full(len(queries), fill_value=np.inf)
+        nearest = np.maximum(distances[found, 0], MIN_DISTANCE)
+        needed[found] = distances[found, rank[found]] / nearest
+        needed.sort()
+        ratio = needed[max(math.ceil(recall_target * len(needed)) - 1, 0)]
+        utils.save_npy(path, np.array([ratio]))
+    return float(np.load(path)[0])
+
+def adaptive_trace_path(index, max_nprobe: int, ratio: float, queries: npt.NDArray) -> str:
+    return probe_trace.trace_path(index, max_nprobe, queries).replace('.trace.npy', f'.adaptive{ratio:.6g}.trace.npy')
+
+def lengths_path(trace_path: str) -> str:
+    return trace_path.replace('.trace.npy', '.lengths.npy')
+
+def get_adaptive_trace(index, max_nprobe: int, ratio: float, queries: npt.NDArray = None) -> tuple[npt.NDArray, npt.NDArray]:
+    """ returns (visits, lengths): the 1D int32 concatenation of the lists each query probes under
+        adaptive probing and how many it probes. Persisted and memory-mapped like probe_trace.get_trace
+    """
+    if queries is None:
+        queries = index.xq
+    path = adaptive_trace_path(index, max_nprobe, ratio, queries)
+    if not os.path.isfile(path) or not os.path.isfile(lengths_path(path)):
+        print(f"Computing adaptive probe trace {path}...")
+        distances, ranking = faiss.knn(queries, index.centroids, max_nprobe)
+        lengths = probe_counts(distances, ratio)
+        visits = ranking[np.arange(max_nprobe)[None, :] < lengths[:, None]]
+        utils.save_npy(lengths_path(path), lengths.astype(np.int32))
+        utils.save_npy(path, visits.astype(np.int32))
+    return np.load(path, mmap_mode='r'), np.load(lengths_path(path), mmap_mode='r')
+
+def adaptive_search(index, max_nprobe: int, ratio: float) -> npt.NDArray:
+    """ searches xq probing the lists of get_adaptive_trace for each query, returns the labels as a 1D array\n
+        the IVF stage is searched with the lists preassigned, so a refine stage is not applied
+    """
+    xq = index.xq
+    distances, ranking = faiss.knn(xq, index.centroids, max_nprobe)
+    lengths = probe_counts(distances, ratio)
+    assign = np.where(np.arange(max_nprobe)[None, :] < lengths[:, None], ranking, -1)
+    coarse = distances
+    if index.index_ivf.metric_type == faiss.METRIC_INNER_PRODUCT:
+        # the IVF expects the quantizer's similarities, not our L2 ranking distances
+        coarse = np.empty_like(distances)
+        for start in range(0, len(xq), probe_trace.REPLAY_CHUNK):
+            end = start + probe_trace.REPLAY_CHUNK
+            coarse[start:end] = np.einsum('nd,nwd->nw', xq[start:end], index.centroids[ranking[start:end]])
+    index.index_ivf.nprobe = max_nprobe
+    _, I = index.index_ivf.search_preassigned(xq, 1, assign, coarse)
+    return I[:, 0]
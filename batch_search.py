@@ -0,0 +1,69 @@
+import faiss
+import time
+import numpy as np
+
+# queries answered together, every list probed by the batch is loaded once
+BATCH_SIZE = 256
+
+def batch_search(index, nprobe: int, k: int = 1, batch_size: int = BATCH_SIZE, store=None) -> dict:
+    """ answers xq list-major: every list a batch probes is loaded once (from store or the index) and scored against
+        all its queries, labels match search(nprobe) up to ties. Returns labels, recall, lists loaded per batch and QPS
+    """
+    d = index.xq.shape[1]
+    if index.index_ivf.code_size != d * 4:
+        raise ValueError(f'batch search only scores Flat IVF lists, not {index.index_type}')
+    inner_product = index.index_ivf.metric_type == faiss.METRIC_INNER_PRODUCT
+    xq = index.xq
+    n = len(xq)
+    distances = np.full((n, k), fill_value=np.inf, dtype=np.float32)
+    labels = np.full((n, k), fill_value=-1, dtype=np.int64)
+    lists_loaded = []
+
+    print(f"Batch search, nprobe={nprobe}, k={k}, batch_size={batch_size}")
+    start = time.perf_counter()
+    for first in range(0, n, batch_size):
+        _, probes = index.index_ivf.quantizer.search(xq[first:first + batch_size], nprobe)
+        # invert the probe map: visits sorted by list, each list's queries are a contiguous run
+        visits = probes.ravel()
+        owners = np.repeat(np.arange(first, first + len(probes)), nprobe)
+        order = np.argsort(visits, kind='stable')
+        visits = visits[order]
+        owners = owners[order]
+        cids, starts = np.unique(visits, return_index=True)
+        ends = np.append(starts[1:], len(visits))
+        lists_loaded.append(len(cids))
+
+        for cid, run_start, run_end in zip(cids.tolist(), starts.tolist(), ends.tolist()):
+            codes, ids = store.read_list(cid) if store is not None else index.get_inverted_list(cid)
+            if len(ids) == 0:
+                continue
+            vectors = codes.view(np.float32)
+            queries = owners[run_start:run_end]
+            products = xq[queries] @ vectors.T
+            if inner_product:
+                scores = -products
+            else:
+                # ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2
+                scores = (xq[queries] ** 2).sum(axis=1)[:, None] - 2 * products + (vectors ** 2).sum(axis=1)[None, :]
+            kk = min(k, len(ids))
+            top = np.argpartition(scores, kk - 1, axis=1)[:, :kk]
+            merged_distances = np.concatenate((distances[queries], np.take_along_axis(scores, top, axis=1)), axis=1)
+            merged_labels = np.concatenate((labels[queries], ids[top]), axis=1)
+            best = np.argsort(merged_distances, axis=1, kind='stable')[:, :k]
+            distances[queries] = np.take_along_axis(merged_distances, best, axis=1)
+            labels[queries] = np.take_along_axis(merged_labels, best, axis=1)
+    elapsed = time.perf_counter() - start
+
+    report = {
+        'labels': labels,
+        'recall': index.report_recall(labels[:, 0]),
+        'lists_loaded': int(sum(lists_loaded)),
+        'list_visits': n * nprobe,
+        'lists_per_batch': float(np.mean(lists_loaded)),
+        'bytes_read': store.bytes_read if store is not None else None,
+        'qps': n / elapsed,
+    }
+    print('Batch search results:')
+    print(f"\t{report['lists_loaded']} lists loaded for {report['list_visits']} probes, {report['lists_per_batch']:.1f} per batch")
+    print(f"\t{report['qps']:.1f} QPS, recall@1 {report['recall']:.3f}")
+    return report
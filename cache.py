@@ -1,6 +1,11 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 import numpy as np
 import random
+import heapq
+import threading
+import time
+from stack_distance import next_access
 
 class Cache(ABC):
 
@@ -27,11 +32,11 @@ class Cache(ABC):
     @abstractmethod
     def num_hits(self) -> int:
         pass
-    
+
     @abstractmethod
     def num_misses(self) -> int:
         pass
-    
+
     @abstractmethod
     def num_vectors_read(self) -> int:
         pass
@@ -40,198 +45,1391 @@ class Cache(ABC):
     def to_string(self) -> str:
         pass
 
+    def observe_trace(self, trace) -> None:
+        """ called with the whole probe trace before it is replayed, only offline policies need it """
+        pass
+
+    # whether the cache needs observe_trace, wrappers only derive a trace for it when it does
+    offline = False
+
+    @abstractmethod
+    def contains(self, cid: int) -> bool:
+        """ returns whether list cid is currently resident, without counting an access """
+        pass
+
+    # whether the cache defines discard(cid), dropping a resident list without counting an access or an eviction,
+    # and reports its evictions through note_eviction, what an exclusive TieredCache needs of its tiers
+    supports_demotion = False
+
+    # lists evicted since a TieredCache last drained them, None (the default) records nothing
+    evictions = None
+
+    def note_eviction(self, cid: int) -> None:
+        if self.evictions is not None:
+            self.evictions.append(cid)
+
+
+class PinCapacityError(Exception):
+    """ raised by a cache's setup when the lists it pins don't fit in its capacity """
+    pass
+
+
+class LinkedStore():
+    """ recency ordered set of cids with a running size, front = most recently used, O(1) operations over an OrderedDict """
+
+    def __init__(self):
+        self.entries = OrderedDict() # cid -> size, the last entry is the front
+        self.size = 0
+
+    def __contains__(self, cid: int) -> bool:
+        return cid in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def push_front(self, cid: int, size: int) -> None:
+        self.entries[cid] = size
+        self.size += size
+
+    def move_to_front(self, cid: int) -> None:
+        self.entries.move_to_end(cid)
+
+    def remove(self, cid: int) -> int:
+        size = self.entries.pop(cid)
+        self.size -= size
+        return size
+
+    def pop_back(self) -> tuple[int, int]:
+        """ removes the least recently used cid, returns (cid, size) """
+        cid, size = self.entries.popitem(last=False)
+        self.size -= size
+        return cid, size
+
+    def peek_back(self) -> tuple[int, int]:
+        """ returns the least recently used (cid, size) without removing it """
+        return next(iter(self.entries.items()))
 
-class LRUCache(Cache):
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+
+class SlotStore():
+    """ unordered set of cids with a running size, supports O(1) removal of a random cid\n
+        cids live in a dense slot array, removal swaps the last slot into the hole
+    """
+
+    def __init__(self):
+        self.slots = []
+        self.positions = {} # cid -> index into slots
+        self.size = 0
+
+    def __contains__(self, cid: int) -> bool:
+        return cid in self.positions
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def add(self, cid: int, size: int) -> None:
+        self.positions[cid] = len(self.slots)
+        self.slots.append((cid, size))
+        self.size += size
+
+    def remove(self, cid: int) -> int:
+        return self.remove_slot(self.positions[cid])[1]
+
+    def remove_slot(self, slot: int) -> tuple[int, int]:
+        cid, size = self.slots[slot]
+        last = self.slots.pop()
+        if slot < len(self.slots):
+            self.slots[slot] = last
+            self.positions[last[0]] = slot
+        del self.positions[cid]
+        self.size -= size
+        return cid, size
+
+    def clear(self) -> None:
+        self.slots.clear()
+        self.positions.clear()
+        self.size = 0
+
+
+class CountingCache(Cache):
+    """ bookkeeping shared by the policies: capacity, list sizes and the hit/miss/read counters\n
+        subclasses implement access_item and get_size, and extend reset with their own state
+    """
 
     def __init__(self, capacity: int):
         self.capacity = capacity
         self.list_sizes = None
-        self.centroids = np.empty(0)
-        self.size = 0
         self.hits = 0
         self.misses = 0
         self.vectors_read = 0
 
     # must be run before using the cache!!
     def setup(self, index):
-        self.list_sizes = index.get_list_sizes()
+        # every policy indexes the list sizes per access, which is much cheaper on a plain list than on the numpy array
+        self.list_sizes = index.get_list_sizes().tolist()
 
     def reset(self):
         self.list_sizes = None
-        self.centroids = np.empty(0)
-        self.size = 0
         self.hits = 0
         self.misses = 0
         self.vectors_read = 0
-        
-    def access_item(self, cid: int) -> None:
-        if cid in self.centroids: # cid is in cache
-            self.centroids = np.delete(self.centroids, np.where(self.centroids == cid))
-            self.size -= self.list_sizes[cid] # need to remove the size here, since we add it back later
-            self.hits += 1
-        else:
-            self.misses += 1
-            self.vectors_read += self.list_sizes[cid]
 
-        # insert cid at the front of cache
-        self.centroids = np.insert(self.centroids, 0, cid)
-        self.size += self.list_sizes[cid]
+    def record_miss(self, cid: int) -> None:
+        self.misses += 1
+        self.vectors_read += self.list_sizes[cid]
 
-        # if cache is too big keep trimming fat until we are under capacity
-        while self.size > self.capacity:
-            self.size -= self.list_sizes[self.centroids[-1]]
-            self.centroids = self.centroids[:-1]
-    
     def get_capacity(self) -> int:
         return self.capacity
-        
-    def get_size(self) -> int:
-        return sum([self.list_sizes[x] for x in self.centroids])
-    
+
     def num_hits(self) -> int:
         return self.hits
-    
+
     def num_misses(self) -> int:
         return self.misses
-    
+
     def num_vectors_read(self) -> int:
         return self.vectors_read
-    
+
     def to_string(self) -> str:
-        return f"LRUCache (capacity={self.get_capacity()})"
-    
+        return f"{type(self).__name__} (capacity={self.get_capacity()})"
 
-class PinCache(Cache):
-    def __init__(self, capacity: int, pincount: int):
-        self.capacity = capacity
-        self.list_sizes = None
+
+class LRUCache(CountingCache):
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.centroids = LinkedStore()
+
+    def reset(self):
+        super().reset()
+        self.centroids.clear()
+
+    @property
+    def size(self) -> int:
+        return self.centroids.size
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        if cid in self.centroids: # cid is in cache
+            self.centroids.move_to_front(cid)
+            self.hits += 1
+        else:
+            self.record_miss(cid)
+            self.centroids.push_front(cid, self.list_sizes[cid])
+
+        # if cache is too big keep trimming fat until we are under capacity
+        while self.centroids.size > self.capacity:
+            self.note_eviction(self.centroids.pop_back()[0])
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.centroids
+
+    def discard(self, cid: int) -> None:
+        if cid in self.centroids:
+            self.centroids.remove(cid)
+
+    def get_size(self) -> int:
+        return self.centroids.size
+
+
+class PinCache(CountingCache):
+    """ LRU cache with a pinned prefix: the pincount largest lists, or with pin_budget the lists pin_planner picks
+        on a workload profiled at nprobe (the test runner plans them at each cell's nprobe)
+    """
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int, pincount: int = 0, pin_budget: int = None, nprobe: int = None):
+        super().__init__(capacity)
         self.pincount = pincount
-        self.size = 0
-        self.hits = 0
-        self.misses = 0
-        self.vectors_read = 0
+        self.pin_budget = pin_budget
+        self.nprobe = nprobe
+        self.pinned = set()
+        self.pinned_size = 0
+        self.centroids = LinkedStore() # unpinned cids, kept in LRU order
 
     def setup(self, index):
-        self.list_sizes = index.get_list_sizes()
-        sorted_dict = dict(sorted(self.list_sizes.items(), key=lambda item: item[1], reverse=True))
-        # Extract keys of the top pincount highest values
-        top_keys = list(sorted_dict.keys())[:self.pincount]
+        super().setup(index)
+        if self.pin_budget is None:
+            # Extract ids of the pincount largest lists (ties go to the lower id)
+            top_keys = np.argsort(-np.asarray(self.list_sizes), kind='stable')[:self.pincount].tolist()
+        else:
+            top_keys = index.get_pin_plan(self.pin_budget, self.nprobe).tolist()
 
         # initialize cache with pinned centroids
         # set the miss/read counts appropriately
-        self.centroids = np.array(top_keys)
-        self.misses = self.pincount
-        for cid in top_keys:
-            self.vectors_read += self.list_sizes[cid]
-        if self.get_size() > self.capacity:
-            raise Exception('Error: Pinned clusters are larger than cache capacity')
-        self.size = self.get_size()
+        self.pinned = set(top_keys)
+        self.pinned_size = sum([self.list_sizes[cid] for cid in top_keys])
+        self.misses = len(top_keys)
+        self.vectors_read += self.pinned_size
+        if self.pinned_size > self.capacity:
+            raise PinCapacityError(f'Pinned clusters ({self.pinned_size}) are larger than cache capacity ({self.capacity})')
 
     def reset(self):
-        self.list_sizes = None
-        self.centroids = np.empty(0)
+        super().reset()
+        self.pinned = set()
+        self.pinned_size = 0
+        self.centroids.clear()
+
+    @property
+    def size(self) -> int:
+        return self.pinned_size + self.centroids.size
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        if cid in self.pinned: # cid is pinned
+            self.hits += 1
+            return
+
+        # cid is not pinned, move it to the front of the cache (but still behind pinned cids)
+        if cid in self.centroids: # cid is in cache but not pinned
+            self.hits += 1
+            self.centroids.move_to_front(cid)
+        else:
+            self.record_miss(cid)
+            self.centroids.push_front(cid, self.list_sizes[cid])
+
+        # if cache is too big keep trimming fat until we are under capacity
+        # pinned cids always fit (checked in setup), so only unpinned cids are evicted
+        while self.pinned_size + self.centroids.size > self.capacity:
+            self.note_eviction(self.centroids.pop_back()[0])
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.pinned or cid in self.centroids
+
+    def discard(self, cid: int) -> None:
+        # pinned lists stay
+        if cid in self.centroids:
+            self.centroids.remove(cid)
+
+    def get_size(self) -> int:
+        return self.size
+
+    def to_string(self) -> str:
+        if self.pin_budget is not None and self.nprobe is not None:
+            return f"PinCache (capacity={self.get_capacity()}, pin_budget={self.pin_budget}, nprobe={self.nprobe})"
+        if self.pin_budget is not None:
+            return f"PinCache (capacity={self.get_capacity()}, pin_budget={self.pin_budget})"
+        return f"PinCache (capacity={self.get_capacity()}, pincount={self.pincount})"
+
+
+class RandomCache(CountingCache):
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.centroids = SlotStore()
+
+    def reset(self):
+        super().reset()
+        self.centroids.clear()
+
+    @property
+    def size(self) -> int:
+        return self.centroids.size
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        if cid in self.centroids: # cid is in cache
+            # take it out while we make room, it is added back below
+            self.centroids.remove(cid)
+            self.hits += 1
+        else:
+            self.record_miss(cid)
+
+        # if cache will be too big keep trimming fat until we are under capacity
+        # lists larger than the whole cache are never admitted
+        if self.capacity > 0 and self.list_sizes[cid] <= self.capacity:
+            while self.centroids.size + self.list_sizes[cid] > self.capacity:
+                self.note_eviction(self.centroids.remove_slot(random.randrange(len(self.centroids)))[0])
+
+            self.centroids.add(cid, self.list_sizes[cid])
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.centroids
+
+    def discard(self, cid: int) -> None:
+        if cid in self.centroids:
+            self.centroids.remove(cid)
+
+    def get_size(self) -> int:
+        return self.centroids.size
+
+
+class LFUCache(CountingCache):
+    """ evicts the least frequently used list, ties broken by recency\n
+        frequencies are only kept for resident lists, buckets of equal frequency are LRU ordered
+    """
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.freqs = {} # cid -> access count
+        self.buckets = {} # access count -> LinkedStore of cids with that count
+        self.min_freq = 0
         self.size = 0
-        self.hits = 0
-        self.misses = 0
-        self.vectors_read = 0
 
+    def reset(self):
+        super().reset()
+        self.freqs = {}
+        self.buckets = {}
+        self.min_freq = 0
+        self.size = 0
+
+    def bucket(self, freq: int) -> LinkedStore:
+        if freq not in self.buckets:
+            self.buckets[freq] = LinkedStore()
+        return self.buckets[freq]
+
+    def evict(self) -> None:
+        bucket = self.buckets[self.min_freq]
+        cid, size = bucket.pop_back()
+        del self.freqs[cid]
+        self.note_eviction(cid)
+        self.size -= size
+        if not bucket:
+            del self.buckets[self.min_freq]
+            self.min_freq = min(self.buckets) if self.buckets else 0
 
     def access_item(self, cid: int) -> None:
-        if cid in self.centroids[:self.pincount]: # cid is pinned
+        cid = int(cid)
+        if cid in self.freqs:
             self.hits += 1
-        elif cid in self.centroids: # cid is in cache but not pinned
+            freq = self.freqs[cid]
+            bucket = self.buckets[freq]
+            size = bucket.remove(cid)
+            if not bucket:
+                del self.buckets[freq]
+                if self.min_freq == freq:
+                    self.min_freq = freq + 1
+            self.freqs[cid] = freq + 1
+            self.bucket(freq + 1).push_front(cid, size)
+            return
+
+        self.record_miss(cid)
+        size = self.list_sizes[cid]
+        if size > self.capacity:
+            return
+        while self.size + size > self.capacity:
+            self.evict()
+        self.freqs[cid] = 1
+        self.bucket(1).push_front(cid, size)
+        self.min_freq = 1
+        self.size += size
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.freqs
+
+    def discard(self, cid: int) -> None:
+        if cid not in self.freqs:
+            return
+        freq = self.freqs.pop(cid)
+        bucket = self.buckets[freq]
+        self.size -= bucket.remove(cid)
+        if not bucket:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = min(self.buckets) if self.buckets else 0
+
+    def get_size(self) -> int:
+        return self.size
+
+
+class ARCCache(CountingCache):
+    """ Adaptive Replacement Cache (Megiddo & Modha) with sizes in vectors: t1/t2 hold resident lists seen once/more,
+        b1/b2 are their ghosts (ids only) and the target size p of t1 adapts on ghost hits
+    """
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.t1 = LinkedStore()
+        self.t2 = LinkedStore()
+        self.b1 = LinkedStore()
+        self.b2 = LinkedStore()
+        self.p = 0
+
+    def reset(self):
+        super().reset()
+        self.t1.clear()
+        self.t2.clear()
+        self.b1.clear()
+        self.b2.clear()
+        self.p = 0
+
+    def replace(self, size: int, in_b2: bool) -> None:
+        """ demotes resident lists to the ghost lists until size more vectors fit """
+        while self.t1.size + self.t2.size + size > self.capacity:
+            if self.t1 and (self.t1.size > self.p or (in_b2 and self.t1.size == self.p) or not self.t2):
+                cid, cid_size = self.t1.pop_back()
+                self.b1.push_front(cid, cid_size)
+            else:
+                cid, cid_size = self.t2.pop_back()
+                self.b2.push_front(cid, cid_size)
+            self.note_eviction(cid)
+
+    def trim_ghosts(self) -> None:
+        """ keeps |t1| + |b1| <= c and the whole directory <= 2c """
+        while self.b1 and self.t1.size + self.b1.size > self.capacity:
+            self.b1.pop_back()
+        while self.b2 and self.t1.size + self.t2.size + self.b1.size + self.b2.size > 2 * self.capacity:
+            self.b2.pop_back()
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        if cid in self.t1:
+            self.hits += 1
+            self.t2.push_front(cid, self.t1.remove(cid))
+            return
+        if cid in self.t2:
             self.hits += 1
-            self.centroids = np.delete(self.centroids, np.where(self.centroids == cid))
-            self.size -= self.list_sizes[cid] # need to remove the size here, since we add it back later
+            self.t2.move_to_front(cid)
+            return
+
+        self.record_miss(cid)
+        size = self.list_sizes[cid]
+        if cid in self.b1:
+            # recency would have helped, grow t1
+            self.p = min(self.capacity, self.p + max(size, size * self.b2.size // max(self.b1.size, 1)))
+            self.b1.remove(cid)
+            if size <= self.capacity:
+                self.replace(size, False)
+                self.t2.push_front(cid, size)
+        elif cid in self.b2:
+            # frequency would have helped, shrink t1
+            self.p = max(0, self.p - max(size, size * self.b1.size // max(self.b2.size, 1)))
+            self.b2.remove(cid)
+            if size <= self.capacity:
+                self.replace(size, True)
+                self.t2.push_front(cid, size)
+        elif size <= self.capacity:
+            self.replace(size, False)
+            self.t1.push_front(cid, size)
+        self.trim_ghosts()
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.t1 or cid in self.t2
+
+    def discard(self, cid: int) -> None:
+        for store in (self.t1, self.t2):
+            if cid in store:
+                store.remove(cid)
+
+    def get_size(self) -> int:
+        return self.t1.size + self.t2.size
+
+
+class TwoQCache(CountingCache):
+    """ full 2Q (Johnson & Shasha): new lists enter the a1in FIFO, its evictions are remembered in the a1out ghost FIFO
+        and a miss on a remembered list admits it to the am LRU, kin and kout size a1in and a1out as fractions of the capacity
+    """
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int, kin: float = 0.25, kout: float = 0.5):
+        super().__init__(capacity)
+        self.kin = kin
+        self.kout = kout
+        self.a1in = LinkedStore()
+        self.a1out = LinkedStore()
+        self.am = LinkedStore()
+
+    def reset(self):
+        super().reset()
+        self.a1in.clear()
+        self.a1out.clear()
+        self.am.clear()
+
+    def reclaim(self, size: int) -> None:
+        while self.a1in.size + self.am.size + size > self.capacity:
+            if self.a1in and (self.a1in.size > self.kin * self.capacity or not self.am):
+                cid, cid_size = self.a1in.pop_back()
+                self.a1out.push_front(cid, cid_size)
+                self.note_eviction(cid)
+                while self.a1out.size > self.kout * self.capacity:
+                    self.a1out.pop_back()
+            else:
+                self.note_eviction(self.am.pop_back()[0])
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        if cid in self.am:
+            self.hits += 1
+            self.am.move_to_front(cid)
+            return
+        if cid in self.a1in:
+            # correlated reference, a1in stays FIFO
+            self.hits += 1
+            return
+
+        self.record_miss(cid)
+        size = self.list_sizes[cid]
+        if size > self.capacity:
+            return
+        if cid in self.a1out:
+            self.a1out.remove(cid)
+            self.reclaim(size)
+            self.am.push_front(cid, size)
         else:
-            self.misses += 1
-            self.vectors_read += self.list_sizes[cid]
+            self.reclaim(size)
+            self.a1in.push_front(cid, size)
 
-        # if cid is not pinned, move it to the front of the cache (but still behind pinned cids)
-        if cid not in self.centroids[:self.pincount]:
-            self.centroids = np.insert(self.centroids, self.pincount, cid)
-            self.size += self.list_sizes[cid]
+    def contains(self, cid: int) -> bool:
+        return cid in self.a1in or cid in self.am
+
+    def discard(self, cid: int) -> None:
+        for store in (self.a1in, self.am):
+            if cid in store:
+                store.remove(cid)
+
+    def get_size(self) -> int:
+        return self.a1in.size + self.am.size
+
+    def to_string(self) -> str:
+        return f"TwoQCache (capacity={self.get_capacity()}, kin={self.kin}, kout={self.kout})"
+
+
+class S3FIFOCache(CountingCache):
+    """ S3-FIFO (Yang et al., SOSP'23): a small FIFO (small_ratio of the capacity) filters one-hit lists, a main FIFO
+        with 2-bit reinsertion holds the rest, and a ghost FIFO sends returning lists straight to main
+    """
+
+    supports_demotion = True
+
+    max_freq = 3
+
+    def __init__(self, capacity: int, small_ratio: float = 0.1):
+        super().__init__(capacity)
+        self.small_ratio = small_ratio
+        self.small = LinkedStore()
+        self.main = LinkedStore()
+        self.ghost = LinkedStore()
+        self.freqs = {} # resident cid -> access count since insertion, capped at max_freq
+
+    def reset(self):
+        super().reset()
+        self.small.clear()
+        self.main.clear()
+        self.ghost.clear()
+        self.freqs = {}
+
+    def evict_small(self) -> None:
+        cid, size = self.small.pop_back()
+        if self.freqs[cid] > 1:
+            self.freqs[cid] = 0
+            self.main.push_front(cid, size)
+        else:
+            del self.freqs[cid]
+            self.note_eviction(cid)
+            self.ghost.push_front(cid, size)
+            while self.ghost.size > self.capacity - self.small_ratio * self.capacity:
+                self.ghost.pop_back()
+
+    def evict_main(self) -> None:
+        while True:
+            cid, size = self.main.pop_back()
+            if self.freqs[cid] > 0:
+                self.freqs[cid] -= 1
+                self.main.push_front(cid, size)
+            else:
+                del self.freqs[cid]
+                self.note_eviction(cid)
+                return
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        if cid in self.freqs:
+            self.hits += 1
+            self.freqs[cid] = min(self.freqs[cid] + 1, self.max_freq)
+            return
+
+        self.record_miss(cid)
+        size = self.list_sizes[cid]
+        if size > self.capacity:
+            return
+        returning = cid in self.ghost
+        if returning:
+            self.ghost.remove(cid)
+        while self.small.size + self.main.size + size > self.capacity:
+            if self.small and (self.small.size >= self.small_ratio * self.capacity or not self.main):
+                self.evict_small()
+            else:
+                self.evict_main()
+        self.freqs[cid] = 0
+        if returning:
+            self.main.push_front(cid, size)
+        else:
+            self.small.push_front(cid, size)
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.freqs
+
+    def discard(self, cid: int) -> None:
+        if cid not in self.freqs:
+            return
+        del self.freqs[cid]
+        for store in (self.small, self.main):
+            if cid in store:
+                store.remove(cid)
+
+    def get_size(self) -> int:
+        return self.small.size + self.main.size
+
+    def to_string(self) -> str:
+        return f"S3FIFOCache (capacity={self.get_capacity()}, small_ratio={self.small_ratio})"
+
+
+class CountMinSketch():
+    """ 4-bit style frequency sketch used by WTinyLFUCache\n
+        depth rows of width counters, every sample_size additions all counters are halved so old popularity fades
+    """
+
+    seeds = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width: int):
+        self.width = 1 << max(4, (width - 1).bit_length()) # power of two so we can mask
+        self.rows = [[0] * self.width for _ in self.seeds]
+        self.sample_size = 10 * self.width
+        self.additions = 0
+
+    def slots(self, cid: int) -> list[int]:
+        return [((cid + 1) * seed >> 7) & (self.width - 1) for seed in self.seeds]
+
+    def add(self, cid: int) -> None:
+        for row, slot in zip(self.rows, self.slots(cid)):
+            if row[slot] < 15:
+                row[slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                for i in range(self.width):
+                    row[i] >>= 1
+            self.additions //= 2
+
+    def estimate(self, cid: int) -> int:
+        return min(row[slot] for row, slot in zip(self.rows, self.slots(cid)))
+
+
+class WTinyLFUCache(CountingCache):
+    """ W-TinyLFU (Einziger et al.): lists leaving a small LRU window only enter the segmented LRU main cache
+        if the count-min sketch says they are more popular than every main list they would displace
+    """
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int, window_ratio: float = 0.01, protected_ratio: float = 0.8):
+        super().__init__(capacity)
+        # the window's share of the capacity, and the protected segment's share of main
+        self.window_ratio = window_ratio
+        self.protected_ratio = protected_ratio
+        self.window = LinkedStore()
+        self.probation = LinkedStore()
+        self.protected = LinkedStore()
+        self.sketch = None
+
+    def setup(self, index):
+        super().setup(index)
+        self.sketch = CountMinSketch(len(self.list_sizes))
+
+    def reset(self):
+        super().reset()
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+        self.sketch = None
+
+    def main_capacity(self) -> int:
+        return self.capacity - int(self.window_ratio * self.capacity)
+
+    def admit(self, cid: int, size: int) -> None:
+        """ admits a list leaving the window into probation if it beats the victims it needs to displace """
+        if size > self.main_capacity():
+            self.note_eviction(cid)
+            return
+        freq = self.sketch.estimate(cid)
+        victims = []
+        freed = 0
+        for segment in (self.probation, self.protected):
+            for victim, victim_size in segment.entries.items(): # LRU first
+                if self.probation.size + self.protected.size - freed + size <= self.main_capacity():
+                    break
+                if self.sketch.estimate(victim) >= freq:
+                    self.note_eviction(cid)
+                    return
+                victims.append((segment, victim))
+                freed += victim_size
+        for segment, victim in victims:
+            segment.remove(victim)
+            self.note_eviction(victim)
+        self.probation.push_front(cid, size)
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        self.sketch.add(cid)
+        if cid in self.window:
+            self.hits += 1
+            self.window.move_to_front(cid)
+            return
+        if cid in self.protected:
+            self.hits += 1
+            self.protected.move_to_front(cid)
+            return
+        if cid in self.probation:
+            self.hits += 1
+            self.protected.push_front(cid, self.probation.remove(cid))
+            while self.protected.size > self.protected_ratio * self.main_capacity():
+                demoted, demoted_size = self.protected.pop_back()
+                self.probation.push_front(demoted, demoted_size)
+            return
+
+        self.record_miss(cid)
+        size = self.list_sizes[cid]
+        if size > self.capacity:
+            return
+        self.window.push_front(cid, size)
+        while self.window.size > self.capacity - self.main_capacity():
+            candidate, candidate_size = self.window.pop_back()
+            self.admit(candidate, candidate_size)
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.window or cid in self.probation or cid in self.protected
+
+    def discard(self, cid: int) -> None:
+        for store in (self.window, self.probation, self.protected):
+            if cid in store:
+                store.remove(cid)
+
+    def get_size(self) -> int:
+        return self.window.size + self.probation.size + self.protected.size
+
+    def to_string(self) -> str:
+        return f"WTinyLFUCache (capacity={self.get_capacity()}, window_ratio={self.window_ratio})"
+
+
+class GDSFCache(CountingCache):
+    """ GreedyDual-Size-Frequency (Cherkasova): evicts the lowest L + frequency * cost / size, L the last evicted priority,
+        a miss costs 1 by default (fewer misses) or with size_cost=True the list size (fewer vectors read)
+    """
+
+    supports_demotion = True
+
+    def __init__(self, capacity: int, size_cost: bool = False):
+        super().__init__(capacity)
+        self.size_cost = size_cost
+        self.inflation = 0.0
+        self.freqs = {} # resident cid -> access count
+        self.priorities = {} # resident cid -> current priority
+        self.heap = [] # (priority, cid), stale entries are skipped when popped
+        self.size = 0
+
+    def reset(self):
+        super().reset()
+        self.inflation = 0.0
+        self.freqs = {}
+        self.priorities = {}
+        self.heap = []
+        self.size = 0
+
+    def prioritize(self, cid: int) -> None:
+        size = self.list_sizes[cid]
+        cost = size if self.size_cost else 1
+        priority = self.inflation + self.freqs[cid] * cost / max(size, 1)
+        self.priorities[cid] = priority
+        heapq.heappush(self.heap, (priority, cid))
+        if len(self.heap) > 4 * len(self.priorities) + 64:
+            # drop stale entries so the heap doesn't grow with the trace
+            self.heap = [(p, c) for c, p in self.priorities.items()]
+            heapq.heapify(self.heap)
+
+    def evict(self) -> None:
+        while True:
+            priority, cid = heapq.heappop(self.heap)
+            if self.priorities.get(cid) == priority:
+                break
+        self.inflation = priority
+        del self.priorities[cid]
+        del self.freqs[cid]
+        self.note_eviction(cid)
+        self.size -= self.list_sizes[cid]
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        if cid in self.freqs:
+            self.hits += 1
+            self.freqs[cid] += 1
+            self.prioritize(cid)
+            return
+
+        self.record_miss(cid)
+        size = self.list_sizes[cid]
+        if size > self.capacity:
+            return
+        while self.size + size > self.capacity:
+            self.evict()
+        self.freqs[cid] = 1
+        self.size += size
+        self.prioritize(cid)
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.freqs
+
+    def discard(self, cid: int) -> None:
+        # its heap entry goes stale
+        if cid in self.freqs:
+            del self.priorities[cid]
+            del self.freqs[cid]
+            self.size -= self.list_sizes[cid]
+
+    def get_size(self) -> int:
+        return self.size
+
+    def to_string(self) -> str:
+        return f"GDSFCache (capacity={self.get_capacity()}, size_cost={self.size_cost})"
+
+
+class StripedCache(Cache):
+    """ thread-safe cache by lock striping: list id modulo segments picks one of `segments` policy caches of capacity / segments,
+        each behind its own lock. lock_wait_seconds sums the time threads spent waiting for the locks
+    """
+
+    def __init__(self, capacity: int, segments: int = 16, policy=LRUCache):
+        self.capacity = capacity
+        self.policy = policy
+        self.segments = [policy(capacity // segments) for _ in range(segments)]
+        self.locks = [threading.Lock() for _ in range(segments)]
+        self.waits = [0.0] * segments
+
+    def __getstate__(self):
+        # locks can't be pickled (pool workers) or deep copied (shards), each copy gets its own
+        state = dict(self.__dict__)
+        del state['locks']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.locks = [threading.Lock() for _ in self.segments]
+
+    # must be run before using the cache!!
+    def setup(self, index):
+        for segment in self.segments:
+            segment.setup(index=index)
+
+    def reset(self):
+        for segment in self.segments:
+            segment.reset()
+        self.waits = [0.0] * len(self.segments)
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        i = cid % len(self.segments)
+        lock = self.locks[i]
+        if not lock.acquire(blocking=False):
+            start = time.perf_counter()
+            lock.acquire()
+            self.waits[i] += time.perf_counter() - start
+        try:
+            self.segments[i].access_item(cid)
+        finally:
+            lock.release()
 
-        # if cache is too big keep trimming fat until we are under capacity
-        while self.size > self.capacity:
-            self.size -= self.list_sizes[self.centroids[-1]]
-            self.centroids = self.centroids[:-1]
-    
     def get_capacity(self) -> int:
         return self.capacity
-    
+
+    def contains(self, cid: int) -> bool:
+        return self.segments[cid % len(self.segments)].contains(cid)
+
+    @property
+    def supports_demotion(self) -> bool:
+        return all(segment.supports_demotion for segment in self.segments)
+
+    def discard(self, cid: int) -> None:
+        i = cid % len(self.segments)
+        with self.locks[i]:
+            self.segments[i].discard(cid)
+
+    # a TieredCache drains and resets the evictions of every segment at once
+    @property
+    def evictions(self) -> list[int]:
+        evicted = [segment.evictions for segment in self.segments]
+        if evicted[0] is None:
+            return None
+        return [cid for segment_evicted in evicted for cid in segment_evicted]
+
+    @evictions.setter
+    def evictions(self, evictions: list[int]) -> None:
+        for segment in self.segments:
+            segment.evictions = None if evictions is None else []
+
     def get_size(self) -> int:
-        return sum([self.list_sizes[x] for x in self.centroids])
+        return sum(segment.get_size() for segment in self.segments)
 
     def num_hits(self) -> int:
-        return self.hits
-    
+        return sum(segment.num_hits() for segment in self.segments)
+
     def num_misses(self) -> int:
-        return self.misses
-    
+        return sum(segment.num_misses() for segment in self.segments)
+
     def num_vectors_read(self) -> int:
-        return self.vectors_read
-    
+        return sum(segment.num_vectors_read() for segment in self.segments)
+
+    def lock_wait_seconds(self) -> float:
+        return sum(self.waits)
+
     def to_string(self) -> str:
-        return f"PinCache (capacity={self.get_capacity()}, pincount={self.pincount})"
-    
-    
-class RandomCache(Cache):
+        return f"StripedCache (capacity={self.capacity}, segments={len(self.segments)}, policy={self.policy.__name__})"
+
+
+class ClockCache(CountingCache):
+    """ CLOCK, an approximate LRU for concurrent readers: a hit only sets the list's reference bit without a lock,
+        a miss takes the lock and sweeps the hand. Counters are per thread so the hit path stays lock-free
+    """
+
+    supports_demotion = True
+
     def __init__(self, capacity: int):
-        self.capacity = capacity
-        self.list_sizes = None
-        self.centroids = np.empty(0)
+        super().__init__(capacity)
+        self.resident = None # per cid, 1 if resident
+        self.referenced = None # per cid, the reference bit
+        self.slots = [] # clock order of the resident cids, -1 for a free slot
+        self.positions = {} # resident cid -> its slot
+        self.free = [] # free slot positions
+        self.hand = 0
         self.size = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = [] # [hits, misses, vectors_read, lock wait] of every thread
+        self.counters_lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks and thread locals can't be pickled (pool workers) or deep copied (shards), each copy gets its own
+        state = dict(self.__dict__)
+        for key in ('lock', 'local', 'counters_lock'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters_lock = threading.Lock()
+        # the copied counters no longer belong to any thread of this copy
+        self.counters = [list(counters) for counters in self.counters]
+
+    # must be run before using the cache!!
+    def setup(self, index):
+        super().setup(index)
+        self.resident = bytearray(len(self.list_sizes))
+        self.referenced = bytearray(len(self.list_sizes))
+
+    def reset(self):
+        super().reset()
+        self.resident = None
+        self.referenced = None
+        self.slots = []
+        self.positions = {}
+        self.free = []
+        self.hand = 0
+        self.size = 0
+        self.local = threading.local()
+        self.counters = []
+
+    def thread_counters(self) -> list:
+        counters = getattr(self.local, 'counters', None)
+        if counters is None:
+            counters = [0, 0, 0, 0.0]
+            self.local.counters = counters
+            with self.counters_lock:
+                self.counters.append(counters)
+        return counters
+
+    def evict(self) -> None:
+        """ advances the hand to the next unreferenced list and evicts it, must hold the lock """
+        while True:
+            if self.hand >= len(self.slots):
+                self.hand = 0
+            cid = self.slots[self.hand]
+            if cid >= 0:
+                if self.referenced[cid]:
+                    self.referenced[cid] = 0
+                else:
+                    self.remove(cid)
+                    self.note_eviction(cid)
+                    return
+            self.hand += 1
+
+    def remove(self, cid: int) -> None:
+        """ frees the slot of resident list cid, must hold the lock """
+        slot = self.positions.pop(cid)
+        self.resident[cid] = 0
+        self.slots[slot] = -1
+        self.free.append(slot)
+        self.size -= self.list_sizes[cid]
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        counters = self.thread_counters()
+        if self.resident[cid]:
+            self.referenced[cid] = 1
+            counters[0] += 1
+            return
+
+        if not self.lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            counters[3] += time.perf_counter() - start
+        try:
+            if self.resident[cid]:
+                # another thread loaded it while we waited
+                self.referenced[cid] = 1
+                counters[0] += 1
+                return
+            counters[1] += 1
+            size = self.list_sizes[cid]
+            counters[2] += size
+            if size > self.capacity:
+                return
+            while self.size + size > self.capacity:
+                self.evict()
+            slot = self.free.pop() if self.free else len(self.slots)
+            if slot == len(self.slots):
+                self.slots.append(cid)
+            else:
+                self.slots[slot] = cid
+            self.positions[cid] = slot
+            self.size += size
+            self.referenced[cid] = 0
+            self.resident[cid] = 1
+        finally:
+            self.lock.release()
+
+    def contains(self, cid: int) -> bool:
+        return bool(self.resident[cid])
+
+    def discard(self, cid: int) -> None:
+        with self.lock:
+            if self.resident[cid]:
+                self.remove(cid)
+
+    def get_size(self) -> int:
+        return self.size
+
+    def num_hits(self) -> int:
+        return sum(counters[0] for counters in self.counters)
+
+    def num_misses(self) -> int:
+        return sum(counters[1] for counters in self.counters)
+
+    def num_vectors_read(self) -> int:
+        return sum(counters[2] for counters in self.counters)
+
+    def lock_wait_seconds(self) -> float:
+        return sum(counters[3] for counters in self.counters)
+
+
+
+class PageIndex():
+    """ stand-in index PagedCache sets its inner cache up with, every page is an item weighing its own size """
+
+    def __init__(self, page_sizes):
+        self.page_sizes = page_sizes
+
+    def get_list_sizes(self):
+        return self.page_sizes
+
+
+class PagedCache(Cache):
+    """ runs the inner cache's policy on pages of page_size, so a huge list is admitted and evicted page by page,
+        with head_pages only the first pages of a list may be cached. Hits, misses and vectors_read count pages
+    """
+
+    def __init__(self, inner: Cache, page_size: int, head_pages: int = None):
+        self.inner = inner
+        self.capacity = inner.capacity
+        self.page_size = page_size
+        self.head_pages = head_pages
+        self.first_page = None # cid -> id of its first page
+        self.n_pages = None # cid -> number of pages
+        self.last_page_size = None # cid -> size of its last page
         self.hits = 0
         self.misses = 0
         self.vectors_read = 0
 
     # must be run before using the cache!!
     def setup(self, index):
-        self.list_sizes = index.get_list_sizes()
+        list_sizes = np.asarray(index.get_list_sizes(), dtype=np.int64)
+        n_pages = -(-list_sizes // self.page_size)
+        first_page = np.concatenate(([0], np.cumsum(n_pages)[:-1]))
+        page_sizes = np.full(int(n_pages.sum()), self.page_size, dtype=np.int64)
+        last_page_size = list_sizes - (n_pages - 1) * self.page_size
+        page_sizes[(first_page + n_pages - 1)[n_pages > 0]] = last_page_size[n_pages > 0]
+        self.first_page = first_page.tolist()
+        self.n_pages = n_pages.tolist()
+        self.last_page_size = last_page_size.tolist()
+        self.inner.setup(index=PageIndex(page_sizes))
 
     def reset(self):
-        self.list_sizes = None
-        self.centroids = np.empty(0)
-        self.size = 0
+        self.inner.reset()
+        self.first_page = None
+        self.n_pages = None
+        self.last_page_size = None
         self.hits = 0
         self.misses = 0
         self.vectors_read = 0
-        
+
+    @property
+    def offline(self) -> bool:
+        return self.inner.offline
+
+    def cached_pages(self, cid: int) -> int:
+        """ number of leading pages of list cid that go through the inner cache """
+        if self.head_pages is None:
+            return self.n_pages[cid]
+        return min(self.n_pages[cid], self.head_pages)
+
+    def observe_trace(self, trace) -> None:
+        """ hands the inner cache the page trace the list trace expands to, if it needs one """
+        if not self.inner.offline:
+            return
+        trace = np.asarray(trace).ravel()
+        counts = np.array([self.cached_pages(cid) for cid in range(len(self.n_pages))], dtype=np.int64)[trace]
+        starts = np.asarray(self.first_page, dtype=np.int64)[trace]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        self.inner.observe_trace(np.repeat(starts, counts) + offsets)
+
     def access_item(self, cid: int) -> None:
-        if cid in self.centroids: # cid is in cache
-            self.centroids = np.delete(self.centroids, np.where(self.centroids == cid))
-            self.size -= self.list_sizes[cid] # need to remove the size here, since we add it back later
-            self.hits += 1
-        else:
-            self.misses += 1
-            self.vectors_read += self.list_sizes[cid]
-            
-        # if cache will be too big keep trimming fat until we are under capacity
-        if self.capacity > 0:
-            while self.size + self.list_sizes[cid] > self.capacity:
-                ind_to_remove = random.randrange(len(self.centroids))
-                self.size -= self.list_sizes[self.centroids[ind_to_remove]]
-                self.centroids = np.delete(self.centroids, ind_to_remove)
-            
-            # insert cid at the front of cache
-            self.centroids = np.insert(self.centroids, 0, cid)
-            self.size += self.list_sizes[cid]
-    
+        cid = int(cid)
+        n = self.n_pages[cid]
+        cached = self.cached_pages(cid)
+        first = self.first_page[cid]
+        for page in range(first, first + cached):
+            self.inner.access_item(page)
+        if cached < n:
+            # the tail beyond the head is never resident
+            self.misses += n - cached
+            self.vectors_read += (n - cached - 1) * self.page_size + self.last_page_size[cid]
+
     def get_capacity(self) -> int:
         return self.capacity
-        
+
+    def contains(self, cid: int) -> bool:
+        """ a list is resident if all of its pages are """
+        first = self.first_page[cid]
+        return self.cached_pages(cid) == self.n_pages[cid] and all(self.inner.contains(page) for page in range(first, first + self.n_pages[cid]))
+
     def get_size(self) -> int:
-        return sum([self.list_sizes[x] for x in self.centroids])
-    
+        return self.inner.get_size()
+
     def num_hits(self) -> int:
-        return self.hits
-    
+        return self.hits + self.inner.num_hits()
+
     def num_misses(self) -> int:
-        return self.misses
-    
+        return self.misses + self.inner.num_misses()
+
     def num_vectors_read(self) -> int:
-        return self.vectors_read
-    
+        return self.vectors_read + self.inner.num_vectors_read()
+
     def to_string(self) -> str:
-        return f"RandomCache (capacity={self.get_capacity()})"
+        return f"PagedCache (page_size={self.page_size}, head_pages={self.head_pages}, {self.inner.to_string()})"
+
+
+class TieredCache(CountingCache):
+    """ hierarchy of caches in front of the backing store, tiers[0] on top, an access is served by the highest tier holding
+        the list. devices names the io_model device of each tier, tier_stats breaks the counts down per tier
+    """
+
+    def __init__(self, tiers: list[Cache], devices: list[str] = None, inclusive: bool = True):
+        if not inclusive:
+            unsupported = [tier.to_string() for tier in tiers if not tier.supports_demotion]
+            if unsupported:
+                raise ValueError(f'exclusive tiers must report their evictions and support discard, {unsupported} do not')
+        offline = [tier.to_string() for tier in tiers[1:] if tier.offline]
+        if offline:
+            raise ValueError(f'lower tiers only see the misses of the tiers above, {offline} need the whole trace')
+        self.tiers = tiers
+        self.devices = devices if devices is not None else ['dram'] * len(tiers)
+        if len(self.devices) != len(tiers):
+            raise ValueError(f'{len(tiers)} tiers but {len(self.devices)} devices')
+        # inclusive: a list is promoted into every tier above the one serving it, each tier evicting on its own.
+        # exclusive: a list lives in one tier, misses and lower hits fill tiers[0] and evictions are demoted a tier down
+        self.inclusive = inclusive
+        super().__init__(sum(tier.capacity for tier in tiers))
+        self.reset_tier_counts()
+
+    def reset_tier_counts(self):
+        self.tier_hits = [0] * len(self.tiers)
+        self.tier_read = [0] * len(self.tiers) # units served by each tier
+        self.tier_filled = [0] * len(self.tiers) # units written into each tier, by promotion or demotion
+
+    # must be run before using the cache!!
+    def setup(self, index):
+        super().setup(index)
+        for tier in self.tiers:
+            tier.setup(index=index)
+            tier.evictions = None if self.inclusive else []
+
+    def reset(self):
+        super().reset()
+        for tier in self.tiers:
+            tier.reset()
+            tier.evictions = None
+        self.reset_tier_counts()
+
+    @property
+    def offline(self) -> bool:
+        return self.tiers[0].offline
+
+    def observe_trace(self, trace) -> None:
+        self.tiers[0].observe_trace(trace)
+
+    def level(self, cid: int) -> int:
+        """ index of the highest tier holding cid, len(tiers) for the backing store """
+        for i, tier in enumerate(self.tiers):
+            if tier.contains(cid):
+                return i
+        return len(self.tiers)
+
+    def fill(self, i: int, cid: int) -> None:
+        """ writes cid into tier i, demoting what it pushes out (exclusive) down the hierarchy """
+        self.tiers[i].access_item(cid)
+        self.tier_filled[i] += self.list_sizes[cid]
+        if not self.inclusive:
+            self.demote(i, cid)
+
+    def demote(self, i: int, cid: int = None) -> None:
+        """ moves the lists tier i evicted, and cid if it wasn't admitted, into tier i + 1 (out of the last tier) """
+        tier = self.tiers[i]
+        evicted = tier.evictions
+        tier.evictions = []
+        if cid is not None and cid not in evicted and not tier.contains(cid):
+            evicted.append(cid)
+        if i + 1 < len(self.tiers):
+            for victim in evicted:
+                self.fill(i + 1, victim)
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        size = self.list_sizes[cid]
+        level = self.level(cid)
+        if level < len(self.tiers):
+            self.hits += 1
+            self.tier_hits[level] += 1
+            self.tier_read[level] += size
+        else:
+            self.record_miss(cid)
+        if self.inclusive:
+            if level < len(self.tiers):
+                # refresh the serving tier's policy
+                self.tiers[level].access_item(cid)
+            for i in range(min(level, len(self.tiers))):
+                self.tiers[i].access_item(cid)
+                self.tier_filled[i] += size
+        elif level == 0:
+            self.tiers[0].access_item(cid)
+            self.demote(0)
+        else:
+            if level < len(self.tiers):
+                self.tiers[level].discard(cid)
+            self.fill(0, cid)
+
+    def contains(self, cid: int) -> bool:
+        return self.level(cid) < len(self.tiers)
+
+    def get_size(self) -> int:
+        return sum(tier.get_size() for tier in self.tiers)
+
+    def tier_stats(self) -> dict:
+        """ per tier hits, units served and units written, next to their device names """
+        return {
+            'devices': list(self.devices),
+            'hits': list(self.tier_hits),
+            'read': list(self.tier_read),
+            'filled': list(self.tier_filled),
+        }
+
+    def to_string(self) -> str:
+        tiers = ', '.join(f"{tier.to_string()} on {device}" for tier, device in zip(self.tiers, self.devices))
+        return f"TieredCache ({'inclusive' if self.inclusive else 'exclusive'}, {tiers})"
+
+
+class BeladyCache(CountingCache):
+    """ offline oracle: on a miss, evicts the resident lists reused furthest in the future only if they are all reused
+        later than the incoming list, else bypasses it. Belady's MIN for equal sizes, a heuristic (not a bound) otherwise
+    """
+
+    offline = True
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.next_use = None
+        self.clock = 0
+        self.resident = {} # cid -> position of its next access
+        self.heap = [] # (-next access, cid), stale entries are skipped
+        self.size = 0
+
+    def observe_trace(self, trace) -> None:
+        # kept as an int64 array, a list of python ints would take several times the memory on long traces
+        self.next_use = next_access(np.asarray(trace).ravel())
+
+    def reset(self):
+        super().reset()
+        self.next_use = None
+        self.clock = 0
+        self.resident = {}
+        self.heap = []
+        self.size = 0
+
+    def furthest(self) -> tuple[int, int]:
+        """ returns (next access, cid) of the resident list reused last """
+        while True:
+            negated, cid = self.heap[0]
+            if self.resident.get(cid) == -negated:
+                return -negated, cid
+            heapq.heappop(self.heap)
+
+    def access_item(self, cid: int) -> None:
+        cid = int(cid)
+        next_use = int(self.next_use[self.clock])
+        self.clock += 1
+        if cid in self.resident:
+            self.hits += 1
+            self.resident[cid] = next_use
+            heapq.heappush(self.heap, (-next_use, cid))
+            return
+
+        self.record_miss(cid)
+        size = self.list_sizes[cid]
+        if size > self.capacity:
+            return
+        # choose the whole victim set before evicting any of it
+        victims = []
+        free = self.capacity - self.size
+        while free < size:
+            victim_use, victim = self.furthest()
+            if next_use >= victim_use:
+                # bypass, the victims chosen so far stay resident
+                for chosen in victims:
+                    heapq.heappush(self.heap, (-self.resident[chosen], chosen))
+                return
+            heapq.heappop(self.heap)
+            victims.append(victim)
+            free += self.list_sizes[victim]
+        for victim in victims:
+            del self.resident[victim]
+            self.size -= self.list_sizes[victim]
+        self.resident[cid] = next_use
+        self.size += size
+        heapq.heappush(self.heap, (-next_use, cid))
+
+    def contains(self, cid: int) -> bool:
+        return cid in self.resident
+
+    def get_size(self) -> int:
+        return self.size
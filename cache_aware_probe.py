@@ -0,0 +1,62 @@
+import faiss
+import os
+import numpy as np
+import numpy.typing as npt
+from cache import Cache
+import probe_trace
+import utils
+
+class CacheAwareProbe():
+    """ probing policy that swaps the last `tail` probes of a query for resident near ties, the lists ranked up to `tail`
+        past them within (1 + slack) times the nprobe-th centroid distance, chosen live while the cache is replayed
+    """
+
+    def __init__(self, slack: float = 0.05, tail: int = 2):
+        self.slack = slack
+        self.tail = tail
+
+    def choose(self, cids: list[int], distances: list[float], nprobe: int, cache: Cache) -> list[int]:
+        """ returns the nprobe lists to probe out of a query's nprobe + tail nearest (cids, ascending distances) """
+        keep = max(nprobe - self.tail, 0)
+        bound = distances[nprobe - 1] * (1 + self.slack)
+        ties = [cid for cid, distance in zip(cids[keep:], distances[keep:]) if distance <= bound]
+        resident = [cid for cid in ties if cache.contains(cid)]
+        missing = [cid for cid in ties if not cache.contains(cid)]
+        return cids[:keep] + (resident + missing)[:nprobe - keep]
+
+    def to_string(self) -> str:
+        return f"cache_aware (slack={self.slack}, tail={self.tail})"
+
+def candidates_path(index, nprobe: int, tail: int) -> str:
+    return probe_trace.trace_path(index, nprobe + tail, index.xq).replace('.trace.npy', '.candidates.npy')
+
+def distances_path(index, nprobe: int, tail: int) -> str:
+    return probe_trace.trace_path(index, nprobe + tail, index.xq).replace('.trace.npy', '.distances.npy')
+
+def get_candidates(index, nprobe: int, tail: int) -> tuple[npt.NDArray, npt.NDArray]:
+    """ returns the (memory-mapped, persisted) nq x (nprobe + tail) nearest centroids of xq and their distances """
+    path = candidates_path(index, nprobe, tail)
+    if not os.path.isfile(path) or not os.path.isfile(distances_path(index, nprobe, tail)):
+        print(f"Computing probe candidates {path}...")
+        distances, ranking = faiss.knn(index.xq, index.centroids, nprobe + tail)
+        utils.save_npy(distances_path(index, nprobe, tail), distances.astype(np.float32))
+        utils.save_npy(path, ranking.astype(np.int32))
+    return np.load(path, mmap_mode='r'), np.load(distances_path(index, nprobe, tail), mmap_mode='r')
+
+def replay_cache_aware(cache: Cache, probe: CacheAwareProbe, candidates: npt.NDArray, distances: npt.NDArray, nprobe: int) -> npt.NDArray:
+    """ replays the queries through cache in order, each probing the lists probe chooses given the cache's
+        current contents, returns the nq x nprobe trace that was actually probed
+    """
+    trace = np.empty((len(candidates), nprobe), dtype=np.int32)
+    for start in range(0, len(candidates), probe_trace.REPLAY_CHUNK):
+        end = start + probe_trace.REPLAY_CHUNK
+        for q, (cids, dists) in enumerate(zip(candidates[start:end].tolist(), distances[start:end].tolist()), start):
+            probes = probe.choose(cids, dists, nprobe, cache)
+            for cid in probes:
+                cache.access_item(cid)
+            trace[q] = probes
+    return trace
+
+def probed_recall(trace: npt.NDArray, gt_lists: npt.NDArray) -> float:
+    """ recall@1 of probing trace on a Flat IVF: a query finds its nn iff it probes the list holding it """
+    return float((np.asarray(trace) == np.asarray(gt_lists)[:, None]).any(axis=1).mean())
@@ -0,0 +1,67 @@
+import time
+import numpy as np
+import numpy.typing as npt
+from concurrent.futures import ThreadPoolExecutor
+from cache import Cache, LRUCache
+
+# queries a serving thread probes (one find_nearest_centroids call) before looking their lists up
+THREAD_BATCH = 64
+THREAD_COUNTS = (1, 2, 4, 8)
+
+def serve(index, cache: Cache, nprobe: int, queries: npt.NDArray, batch_size: int) -> int:
+    """ one serving thread: probes its queries batch by batch and looks every probed list up in the shared cache,
+        returns the number of lookups
+    """
+    accesses = 0
+    for start in range(0, len(queries), batch_size):
+        probes = index.find_nearest_centroids(nprobe, queries[start:start + batch_size])
+        for cid in probes.ravel().tolist():
+            cache.access_item(cid)
+        accesses += probes.size
+    return accesses
+
+def exact_lru_hit_ratio(index, capacity: int, nprobe: int) -> float:
+    """ hit ratio of the exact single-threaded LRUCache of the same capacity over xq in order """
+    lru = LRUCache(capacity)
+    lru.setup(index=index)
+    for cid in np.asarray(index.get_trace(nprobe)).ravel().tolist():
+        lru.access_item(cid)
+    return lru.num_hits() / max(lru.num_hits() + lru.num_misses(), 1)
+
+def run_concurrent_benchmark(index, caches: list[Cache], nprobe: int, threads: tuple[int] = THREAD_COUNTS,
+                             batch_size: int = THREAD_BATCH) -> list[dict]:
+    """ serves xq from n threads sharing one thread-safe cache for every n in threads, batches dealt round-robin, and returns
+        one report per (cache, threads) with the hit ratio next to the exact single-threaded LRU's and the speedup
+    """
+    queries = index.xq
+    batches = [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+    reports = []
+    for cache in caches:
+        exact = exact_lru_hit_ratio(index, cache.capacity, nprobe)
+        base_qps = None
+        for n in threads:
+            cache.reset()
+            cache.setup(index=index)
+            # thread t serves batches t, t + n, ...
+            slices = [np.concatenate(batches[t::n]) for t in range(n) if batches[t::n]]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n) as pool:
+                accesses = sum(pool.map(lambda part: serve(index, cache, nprobe, part, batch_size), slices))
+            elapsed = time.perf_counter() - start
+            if base_qps is None:
+                base_qps = len(queries) / elapsed
+            wait = cache.lock_wait_seconds() if hasattr(cache, 'lock_wait_seconds') else None
+            report = {
+                'cache': cache.to_string(),
+                'threads': n,
+                'qps': len(queries) / elapsed,
+                'accesses_per_s': accesses / elapsed,
+                'speedup': len(queries) / elapsed / base_qps,
+                'hit_ratio': cache.num_hits() / max(cache.num_hits() + cache.num_misses(), 1),
+                'exact_lru_hit_ratio': exact,
+                'lock_wait_s': wait,
+            }
+            reports.append(report)
+            print(f"{report['cache']}, {n} threads: {report['qps']:.1f} QPS ({report['speedup']:.2f}x), {report['accesses_per_s']:.0f} lookups/s, "
+                  f"hit ratio {report['hit_ratio']:.4f} (exact LRU {exact:.4f})" + (f", lock wait {wait:.3f}s" if wait is not None else ''))
+    return reports
@@ -0,0 +1,200 @@
+import faiss
+import mmap
+import os
+import time
+import numpy as np
+import numpy.typing as npt
+from cache import Cache
+import list_layout
+import utils
+
+# every list starts on a block boundary and is padded to a whole number of blocks, as O_DIRECT requires
+BLOCK_SIZE = 4096
+
+def layout_path(index, layout: str = 'id', nprobe: int = None) -> str:
+    suffix = '' if layout == 'id' else f'.{list_layout.layout_name(layout, nprobe)}'
+    return f'indexes/{index.dataset}/{index.index_type}.lists{suffix}'
+
+def offsets_name(layout: str = 'id', nprobe: int = None) -> str:
+    return 'layout' if layout == 'id' else f'layout.{list_layout.layout_name(layout, nprobe)}'
+
+def write_layout(index, order: npt.NDArray = None, layout: str = 'id', nprobe: int = None) -> npt.NDArray:
+    """ writes the inverted lists (codes, then int64 ids) block aligned to layout_path in the given order (default: id order)
+        and saves their byte offsets as a sidecar, returns the offsets indexed by list id
+    """
+    invlists = index.index_ivf.invlists
+    list_sizes = index.get_list_sizes()
+    if order is None:
+        order = np.arange(invlists.nlist)
+    offsets = np.zeros(invlists.nlist, dtype=np.int64)
+    path = layout_path(index, layout, nprobe)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    print(f"Writing list layout {path}...")
+    with open(tmp_path, 'wb') as f:
+        offset = 0
+        for cid in np.asarray(order).tolist():
+            n = int(list_sizes[cid])
+            offsets[cid] = offset
+            if n == 0:
+                continue
+            codes, ids = index.get_inverted_list(cid)
+            codes = codes.tobytes()
+            ids = ids.tobytes()
+            length = len(codes) + len(ids)
+            padded = -(-length // BLOCK_SIZE) * BLOCK_SIZE
+            f.write(codes)
+            f.write(ids)
+            f.write(bytes(padded - length))
+            offset += padded
+    os.replace(tmp_path, path)
+    utils.save_npy(index.sidecar_path(offsets_name(layout, nprobe)), offsets)
+    return offsets
+
+class DiskListStore():
+    """ reads inverted lists from a layout file with pread, optionally with O_DIRECT so the OS page cache doesn't
+        hide the device. The file is written in the given order on first use
+    """
+
+    def __init__(self, index, direct: bool = False, layout: str = 'id', order: npt.NDArray = None, nprobe: int = None):
+        path = layout_path(index, layout, nprobe)
+        offsets_path = index.sidecar_path(offsets_name(layout, nprobe))
+        if not os.path.isfile(path) or not os.path.isfile(offsets_path):
+            write_layout(index, order, layout, nprobe)
+        self.offsets = np.load(offsets_path).tolist()
+        self.list_sizes = index.get_list_sizes().tolist()
+        self.code_size = index.index_ivf.code_size
+        self.padded = index.get_list_bytes(BLOCK_SIZE).tolist()
+        self.direct = direct
+        flags = os.O_RDONLY
+        if direct:
+            flags |= os.O_DIRECT
+        self.fd = os.open(path, flags)
+        self.bytes_read = 0
+        self.requests = 0
+
+    def list_bytes(self, cid: int) -> int:
+        return self.list_sizes[cid] * (self.code_size + 8)
+
+    def read_extent(self, offset: int, length: int) -> npt.NDArray:
+        """ reads length bytes at offset with a single request, returns them as a uint8 array """
+        self.requests += 1
+        if self.direct:
+            # O_DIRECT needs an aligned buffer and a whole number of blocks, anonymous mmaps are page aligned
+            padded = -(-length // BLOCK_SIZE) * BLOCK_SIZE
+            buf = mmap.mmap(-1, padded)
+            os.preadv(self.fd, [buf], offset)
+            data = np.frombuffer(buf, dtype=np.uint8, count=length).copy()
+            buf.close()
+            self.bytes_read += padded
+        else:
+            data = np.frombuffer(os.pread(self.fd, length, offset), dtype=np.uint8)
+            self.bytes_read += length
+        return data
+
+    def split_list(self, cid: int, data: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        n = self.list_sizes[cid]
+        codes = data[:n * self.code_size].reshape(n, self.code_size)
+        ids = data[n * self.code_size:n * (self.code_size + 8)].view(np.int64)
+        return codes, ids
+
+    def read_list(self, cid: int) -> tuple[npt.NDArray, npt.NDArray]:
+        """ returns (codes as an n x code_size uint8 array, ids) of list cid """
+        length = self.list_bytes(cid)
+        if length == 0:
+            return np.empty((0, self.code_size), dtype=np.uint8), np.empty(0, dtype=np.int64)
+        return self.split_list(cid, self.read_extent(self.offsets[cid], length))
+
+    def read_lists(self, cids: list[int], max_gap: int = 0) -> dict:
+        """ reads lists cids with one request per run of lists at most max_gap bytes apart in the file
+            (see list_layout.read_runs), returns cid -> (codes, ids)
+        """
+        lists = {cid: self.read_list(cid) for cid in cids if self.list_sizes[cid] == 0}
+        runs = list_layout.read_runs(cids, self.offsets, self.padded, max_gap)
+        members = sorted((cid for cid in set(cids) if self.list_sizes[cid] > 0), key=lambda x: self.offsets[x])
+        i = 0
+        for offset, length in runs:
+            data = self.read_extent(offset, length)
+            while i < len(members) and self.offsets[members[i]] < offset + length:
+                cid = members[i]
+                start = self.offsets[cid] - offset
+                lists[cid] = self.split_list(cid, data[start:start + self.list_bytes(cid)])
+                i += 1
+        return lists
+
+    def close(self):
+        os.close(self.fd)
+
+def run_disk_search(index, cache: Cache, nprobe: int, direct: bool = False, cache_index=None,
+                    layout: str = 'id', order: npt.NDArray = None, max_gap: int = 0) -> dict:
+    """ answers xq (k=1) from the Flat IVF lists of a layout on disk through a buffer following cache's policy, reading
+        each query's misses in runs at most max_gap bytes apart. Returns the labels, measured I/O and latencies
+    """
+    d = index.xq.shape[1]
+    if index.index_ivf.code_size != d * 4:
+        raise ValueError(f'disk search only scans Flat IVF lists, not {index.index_type}')
+    inner_product = index.index_ivf.metric_type == faiss.METRIC_INNER_PRODUCT
+
+    store = DiskListStore(index, direct, layout, order, nprobe)
+    trace = index.get_trace(nprobe)
+    cache.reset()
+    # cache_index (e.g. the runner's cell view) sizes the lists the same way as the simulation
+    cache.setup(index=cache_index if cache_index is not None else index)
+    cache.observe_trace(trace)
+    buffer = {} # resident cid -> (vectors, ids)
+    labels = np.full(len(index.xq), fill_value=-1, dtype=np.int64)
+    latencies = np.zeros(len(index.xq))
+
+    print(f"Disk search with {cache.to_string()}, nprobe={nprobe}, O_DIRECT={direct}, layout={layout}, max_gap={max_gap}")
+    start = time.perf_counter()
+    for q, probes in enumerate(np.asarray(trace).tolist()):
+        query_start = time.perf_counter()
+        query = index.xq[q]
+        best_distance = np.inf
+        # the buffer only changes after the query, so its misses can be read up front in merged runs
+        for cid in probes:
+            cache.access_item(cid)
+        lists = store.read_lists([cid for cid in probes if cid not in buffer], max_gap)
+        for cid in probes:
+            if cid in buffer:
+                vectors, ids = buffer[cid]
+            else:
+                codes, ids = lists[cid]
+                vectors = codes.view(np.float32)
+                if cache.contains(cid):
+                    buffer[cid] = (vectors, ids)
+            if len(ids) == 0:
+                continue
+            if inner_product:
+                distances = -(vectors @ query)
+            else:
+                distances = ((vectors - query) ** 2).sum(axis=1)
+            i = int(distances.argmin())
+            if distances[i] < best_distance:
+                best_distance = distances[i]
+                labels[q] = ids[i]
+        latencies[q] = time.perf_counter() - query_start
+        # drop the bytes of lists the policy evicted
+        for cid in [x for x in buffer if not cache.contains(x)]:
+            del buffer[cid]
+    elapsed = time.perf_counter() - start
+    store.close()
+
+    report = {
+        'labels': labels,
+        'recall': index.report_recall(labels),
+        'hits': cache.num_hits(),
+        'misses': cache.num_misses(),
+        'vectors_read': cache.num_vectors_read(),
+        'bytes_read': store.bytes_read,
+        'read_requests': store.requests,
+        'requests_per_query': store.requests / len(index.xq),
+        'bytes_per_query': store.bytes_read / len(index.xq),
+        'qps': len(index.xq) / elapsed,
+        'latency_p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'latency_p95_ms': float(np.percentile(latencies, 95) * 1000),
+        'latency_p99_ms': float(np.percentile(latencies, 99) * 1000),
+    }
+    print('Disk search results:')
+    print(f"\t{report['hits']} cache hits, {report['misses']} disk reads, {report['bytes_read']} bytes read in {report['read_requests']} requests")
+    print(f"\t{report['qps']:.1f} QPS, latency p50={report['latency_p50_ms']:.3f}ms p95={report['latency_p95_ms']:.3f}ms p99={report['latency_p99_ms']:.3f}ms")
+    return report
@@ -3,10 +3,32 @@ import os
 import numpy as np
 import numpy.typing as npt
 from cache import Cache
+from query_scheduler import QuerySchedule
+import batch_search
+import adaptive_probe
+import cache_aware_probe
+from cache_aware_probe import CacheAwareProbe
+import workload
+from workload import Workload
+from partitioning import Partitioning
+import sharding
+from sharding import Sharding
+import io_model
+import concurrent_bench
+import pin_planner
+import probe_trace
+import utils
+
+# refine candidates fetched per result when the index has a refine stage (faiss' IndexRefine k_factor)
+REFINE_K_FACTOR = 10
 
 class Index:
 
-    def __init__(self, dataset: str, index_type: str, xt: npt.NDArray, xb: npt.NDArray, xq: npt.NDArray, gt: npt.NDArray):
+    def __init__(self, dataset: str, index_type: str, xt: npt.NDArray, xb: npt.NDArray, xq: npt.NDArray, gt: npt.NDArray,
+                 partitioning: Partitioning = None):
+        """ opens indexes/<dataset>/<index_type>.index, building it with index_factory first if it is missing,
+            a partitioning splits its lists and suffixes index_type (see Partitioning)
+        """
         if dataset == 'sift':
             distance_metric = faiss.METRIC_L2
         elif dataset.startswith('glove'):
@@ -14,12 +36,21 @@ class Index:
             faiss.normalize_L2(xt)
             faiss.normalize_L2(xb)
             faiss.normalize_L2(xq)
+        factory = index_type
+        if partitioning is not None:
+            index_type = f'{index_type}{partitioning.suffix()}'
+        trained = False
         try:
             index = faiss.read_index(f'indexes/{dataset}/{index_type}.index', faiss.IO_FLAG_MMAP)
         except:
-            index = faiss.index_factory(xt.shape[1], index_type, distance_metric)
+            trained = True
+            index = faiss.index_factory(xt.shape[1], factory, distance_metric)
+            if partitioning is not None:
+                partitioning.check(index)
             print(f"Training {index_type} index on {dataset}...")
             index.train(xt)
+            if partitioning is not None:
+                partitioning.apply(index, xt, xb)
             index.add(xb)
             print(f"Write indexes/{dataset}/{index_type}.index")
             if not os.path.exists(f'indexes/{dataset}'):
@@ -29,15 +60,62 @@ class Index:
         self.dataset = dataset
         self.index = index
         self.index_ivf = faiss.extract_index_ivf(index)
+        if self.has_refine():
+            index.k_factor = REFINE_K_FACTOR
         self.xb = xb
         self.xt = xt
         self.xq = xq
         self.gt = gt
+        # a freshly built index invalidates everything derived from the previous one
+        self.rebuilt = trained
+        if trained:
+            self.remove_derived_files()
+        self.load_metadata(rebuild=trained)
+
+    def sidecar_path(self, name: str) -> str:
+        """ returns the path of a metadata file stored next to the index file """
+        return f'indexes/{self.dataset}/{self.index_type}.{name}.npy'
+
+    def remove_derived_files(self):
+        """ deletes the sidecars, traces, pin plans, layouts and shard maps at indexes/<dataset>/<index_type>.*,
+            keeping the files of other indexes sharing the prefix (a partitioned index_type + suffix)
+        """
+        directory = f'indexes/{self.dataset}'
+        prefix = f'{self.index_type}.'
+        names = os.listdir(directory)
+        others = [name[:-len('index')] for name in names if name.startswith(prefix) and name.endswith('.index') and name != f'{prefix}index']
+        for name in names:
+            if name.startswith(prefix) and name != f'{prefix}index' and not any(name.startswith(other) for other in others):
+                os.remove(os.path.join(directory, name))
+
+    def load_metadata(self, rebuild: bool = False):
+        """ loads the list sizes (int64 array) and centroids (float32 nlist x d matrix) from their
+            sidecar files, computing and saving them first if they are missing or the index was just rebuilt
+        """
+        list_sizes_path = self.sidecar_path('list_sizes')
+        centroids_path = self.sidecar_path('centroids')
+        if rebuild or not os.path.isfile(list_sizes_path) or not os.path.isfile(centroids_path):
+            print(f"Computing metadata for indexes/{self.dataset}/{self.index_type}.index...")
+            invlists = self.index_ivf.invlists
+            list_sizes = np.fromiter((invlists.list_size(i) for i in range(invlists.nlist)), dtype=np.int64, count=invlists.nlist)
+            centroids = self.index_ivf.quantizer.reconstruct_n(0, self.index_ivf.nlist).astype(np.float32)
+            utils.save_npy(list_sizes_path, list_sizes)
+            utils.save_npy(centroids_path, centroids)
+        self.list_sizes = np.load(list_sizes_path)
+        self.centroids = np.load(centroids_path)
+
+    def has_refine(self) -> bool:
+        """ True if the index re-ranks its IVF candidates with a refine stage (e.g. a ",RFlat" factory suffix) """
+        return isinstance(self.index, faiss.IndexRefine)
+
+    def is_flat(self) -> bool:
+        """ True if the IVF lists hold the raw float32 vectors and nothing re-ranks them """
+        return isinstance(self.index_ivf, faiss.IndexIVFFlat) and not self.has_refine()
 
     def search(self, nprobe: int) -> npt.NDArray:
-        """ performs the standard search on xq, returns the labels as a 1D array """
+        """ performs the standard search on xq (through the refine stage if there is one), returns the labels as a 1D array """
         self.index_ivf.nprobe = nprobe
-        _, I = self.index_ivf.search(self.xq, k=1)
+        _, I = self.index.search(self.xq, k=1)
         labels = I[:, :1]
         labels = [x[0] for x in labels]
         # print(f'labels: {labels.size} - {np.min(labels)} -> {np.max(labels)}')
@@ -82,47 +160,175 @@ class Index:
         # print(f'labels: {labels.shape} - {np.min(labels)} -> {np.max(labels)}')
         return query_centroid_ids, result_centroid_ids, labels
     
-    def get_list_sizes(self) -> dict[int, int]:
-        """ returns a dictionary containing the size of each inverted list,
+    def get_inverted_list(self, cid: int) -> tuple[npt.NDArray, npt.NDArray]:
+        """ returns copies of (codes as an n x code_size uint8 array, int64 ids) of inverted list cid """
+        invlists = self.index_ivf.invlists
+        n = invlists.list_size(cid)
+        code_size = invlists.code_size
+        if n == 0:
+            return np.empty((0, code_size), dtype=np.uint8), np.empty(0, dtype=np.int64)
+        codes_ptr = invlists.get_codes(cid)
+        ids_ptr = invlists.get_ids(cid)
+        codes = faiss.rev_swig_ptr(codes_ptr, n * code_size).copy().reshape(n, code_size)
+        ids = faiss.rev_swig_ptr(ids_ptr, n).astype(np.int64)
+        invlists.release_codes(cid, codes_ptr)
+        invlists.release_ids(cid, ids_ptr)
+        return codes, ids
+
+    def get_list_sizes(self) -> npt.NDArray:
+        """ returns an int64 array containing the size of each inverted list,
             size = # of vectors
         """
-        invlists = self.index_ivf.invlists
-        d = {}
-        for i in range(invlists.nlist):
-            d[i] = invlists.list_size(i)
-        return d
+        return self.list_sizes
     
+    def get_list_bytes(self, block_size: int = 4096) -> npt.NDArray:
+        """ returns an int64 array with the bytes each inverted list occupies on disk (codes plus 8 byte ids),
+            rounded up to whole blocks of block_size, 1 means no rounding
+        """
+        nbytes = self.list_sizes * (self.index_ivf.code_size + 8)
+        return -(-nbytes // block_size) * block_size
+
+    def get_refine_bytes(self, block_size: int = 4096) -> int:
+        """ returns the bytes one refine fetch reads, the vector's refine code (the raw vector for RFlat)
+            rounded up to a whole block of block_size, 1 means no rounding
+        """
+        nbytes = self.index.refine_index.sa_code_size()
+        return -(-nbytes // block_size) * block_size
+
     def report_recall(self, ids: npt.NDArray, verbose=False) -> float:
         """ compares ids to gt, reports recall to stdout """
-        recall_at_1 = (ids == self.gt[:, :1]).sum() / float(self.xq.shape[0])
+        # compare 1D against 1D, a 1D ids against the n x 1 gt column would broadcast to n x n
+        recall_at_1 = (np.asarray(ids).ravel() == self.gt[:, 0]).sum() / float(self.xq.shape[0])
         if verbose:
             print("recall@1: %.3f" % recall_at_1)
         return recall_at_1
 
 
-    def find_nearest_centroids(self, k: int) -> npt.NDArray:
+    def recall_curve(self, max_nprobe: int) -> npt.NDArray:
+        """ returns recall@1 of search(nprobe) for every nprobe in [0, max_nprobe], exact only when is_flat(): the NN is
+            found iff the list of its gt vector is probed, so one centroid ranking of xq gives the whole curve
+        """
+        max_nprobe = min(max_nprobe, self.index_ivf.nlist)
+        _, ranking = self.index_ivf.quantizer.search(self.xq, max_nprobe)
+        gt_lists = self.get_gt_lists()
+        probed = ranking == gt_lists[:, None]
+        found = probed.any(axis=1)
+        rank = probed.argmax(axis=1)
+        found_at = np.bincount(rank[found], minlength=max_nprobe)
+        return np.concatenate(([0], np.cumsum(found_at))) / float(self.xq.shape[0])
+
+    def get_gt_lists(self) -> npt.NDArray:
+        """ returns the (persisted) id of the inverted list holding the gt nearest neighbor of each query """
+        path = self.sidecar_path('gt_lists')
+        if not os.path.isfile(path):
+            utils.save_npy(path, self.index_ivf.quantizer.assign(self.xb[self.gt[:, 0]], 1).ravel())
+        return np.load(path)
+
+    def get_pin_plan(self, budget: int, nprobe: int) -> npt.NDArray:
+        """ returns the (persisted) ids of the lists to pin under budget vectors, planned on the probe trace
+            of the profiled xt queries at nprobe (see pin_planner.get_pin_plan)
+        """
+        if nprobe is None:
+            raise ValueError('a pin plan is profiled at a given nprobe, pass PinCache(..., pin_budget=..., nprobe=...)')
+        profile = pin_planner.profile_queries(self)
+        self.get_trace(nprobe, profile)
+        return pin_planner.get_pin_plan(probe_trace.trace_path(self, nprobe, profile), self.get_list_sizes(), budget)
+
+    def find_nearest_centroids(self, k: int, queries: npt.NDArray = None) -> npt.NDArray:
         """ our own method that uses faiss.knn to return the k closest centroids to each query vector\n
-            returns an nxk array
+            queries defaults to xq, returns an nxk array
         """
-        centroids = self.index.quantizer.reconstruct_n(0, self.index.nlist)
-        _, centroid_idxs = faiss.knn(self.xq, centroids, k)
+        if queries is None:
+            queries = self.xq
+        _, centroid_idxs = faiss.knn(queries, self.centroids, k)
         return centroid_idxs
+
+    def get_trace(self, nprobe: int, queries: npt.NDArray = None) -> npt.NDArray:
+        """ returns the (memory-mapped, persisted) nxnprobe probe trace of queries, see probe_trace.get_trace """
+        return probe_trace.get_trace(self, nprobe, queries)
+
+    def batch_search(self, nprobe: int, k: int = 1, batch_size: int = batch_search.BATCH_SIZE, store=None) -> dict:
+        """ list-major batched search of xq, optionally loading the lists from a disk_store.DiskListStore, see batch_search.batch_search """
+        return batch_search.batch_search(self, nprobe, k, batch_size, store)
+
+    def learn_probe_ratio(self, max_nprobe: int, recall_target: float) -> float:
+        """ distance ratio adaptive probing needs to reach recall_target, see adaptive_probe.learn_probe_ratio """
+        return adaptive_probe.learn_probe_ratio(self, max_nprobe, recall_target)
+
+    def get_adaptive_trace(self, max_nprobe: int, ratio: float, queries: npt.NDArray = None) -> tuple[npt.NDArray, npt.NDArray]:
+        """ returns the (memory-mapped, persisted) visits and per-query lengths of adaptive probing, see adaptive_probe.get_adaptive_trace """
+        return adaptive_probe.get_adaptive_trace(self, max_nprobe, ratio, queries)
+
+    def adaptive_search(self, max_nprobe: int, ratio: float) -> npt.NDArray:
+        """ searches xq with adaptive probing, returns the labels as a 1D array """
+        return adaptive_probe.adaptive_search(self, max_nprobe, ratio)
+
+    def get_workload_trace(self, nprobe: int, stream: Workload) -> npt.NDArray:
+        """ returns the (memory-mapped, persisted) probe trace of a synthetic query stream, see workload.get_workload_trace """
+        return workload.get_workload_trace(self, nprobe, stream)
+
+    def get_refine_trace(self, nprobe: int, queries: npt.NDArray = None) -> npt.NDArray:
+        """ returns the (memory-mapped, persisted) ids of the raw vectors the refine stage fetches, see probe_trace.get_refine_trace """
+        return probe_trace.get_refine_trace(self, nprobe, queries)
     
-    def simulate_cache(self, cache: Cache, nprobe: int) -> tuple[int, int]:
-        """ performs the simulation of disk reads using the cache passed in\n
+    def stream_simulation(self, cache: Cache, nprobe: int, queries=None, chunk_size: int = probe_trace.STREAM_CHUNK):
+        """ streams the probes of queries (an array, default xq, or an iterator of (start, queries) chunks) into cache,
+            yielding running statistics after every chunk (see probe_trace.stream_simulation), nothing is persisted
+        """
+        if queries is None:
+            queries = self.xq
+        if isinstance(queries, np.ndarray):
+            queries = probe_trace.query_chunks(queries, chunk_size)
+        probe_chunks = probe_trace.stream_probes(self, nprobe, queries)
+        return probe_trace.stream_simulation(cache, probe_chunks, self.index_ivf.code_size + 8)
+
+    def concurrent_benchmark(self, caches: list[Cache], nprobe: int, threads: tuple[int] = concurrent_bench.THREAD_COUNTS) -> list[dict]:
+        """ serves xq from 1 to N threads sharing each (thread-safe) cache, see concurrent_bench.run_concurrent_benchmark """
+        return concurrent_bench.run_concurrent_benchmark(self, caches, nprobe, threads)
+
+    def simulate_shards(self, cache: Cache, nprobe: int, shards: Sharding, device: str = 'nvme') -> dict:
+        """ simulates serving xq from the lists spread over shards, every node running its own copy of cache
+            (each with the full capacity), see sharding.simulate_shards. Returns its report
+        """
+        print(f"Simulating {cache.to_string()} on {shards.to_string()}, nprobe={nprobe}")
+        caches = sharding.shard_caches(cache, shards.n_shards)
+        for node_cache in caches:
+            node_cache.reset()
+            node_cache.setup(index=self)
+        shard_of = sharding.get_shard_map(self, shards, nprobe)
+        report = sharding.simulate_shards(caches, self.get_trace(nprobe), shard_of, io_model.DEVICES[device], self.index_ivf.code_size + 8)
+        print('Sharded simulation results:')
+        print(f"\t{report['hits']} cache hits, {report['misses']} disk reads, {report['read']} vectors read")
+        print(f"\tfan-out {report['fanout_mean']:.2f} nodes per query (p99 {report['fanout_p99']:.0f}), load imbalance {report['load_imbalance']:.2f}")
+        print(f"\tlatency p50={report['latency_p50_ms']:.3f}ms p99={report['latency_p99_ms']:.3f}ms")
+        return report
+
+    def simulate_cache(self, cache: Cache, nprobe: int, schedule: QuerySchedule = None, probe: CacheAwareProbe = None) -> tuple[int, int]:
+        """ performs the simulation of disk reads using the cache passed in, queries reordered by schedule or probed by probe\n
             returns the number of unique centroids and number of unique vectors accessed
         """
         print("Starting simulation...")
         print(f"\tIndex type: {self.index_type}")
         print(f"\tCache type: {cache.to_string()}")
-        centroid_idxs = self.find_nearest_centroids(nprobe).flatten()
+        centroid_idxs = self.get_trace(nprobe)
         list_sizes = self.get_list_sizes()
-        
-        for centroid in centroid_idxs:
-            cache.access_item(centroid)
+        if schedule is not None:
+            print(f"\tSchedule: {schedule.to_string()}")
+            centroid_idxs, _ = schedule.apply(centroid_idxs)
+
+        if probe is not None:
+            print(f"\tProbing: {probe.to_string()}")
+            candidates, distances = cache_aware_probe.get_candidates(self, nprobe, probe.tail)
+            centroid_idxs = cache_aware_probe.replay_cache_aware(cache, probe, candidates, distances, nprobe)
+            print(f"\trecall@1 {cache_aware_probe.probed_recall(centroid_idxs, self.get_gt_lists()):.4f}")
+        else:
+            cache.observe_trace(centroid_idxs)
+            chunks = probe_trace.trace_chunks(centroid_idxs)
+            for stats in probe_trace.stream_simulation(cache, chunks, self.index_ivf.code_size + 8):
+                print(f"\t{stats['queries']} queries: hit ratio {stats['hit_ratio']:.4f} ({stats['window_hit_ratio']:.4f} in the last chunk), {stats['bytes_read']} bytes read")
 
-        unique_centroids_accessed = np.unique(centroid_idxs)
-        num_unique_vectors_read = sum([list_sizes[x] for x in unique_centroids_accessed])
+        unique_centroids_accessed = probe_trace.probed_lists(centroid_idxs, len(list_sizes))
+        num_unique_vectors_read = int(list_sizes[unique_centroids_accessed].sum())
         print('Simulation results:')
         print(f'\t{cache.num_hits()} cache hits')
         print(f'\t{cache.num_misses()} disk reads ({len(unique_centroids_accessed)} unavoidable)')
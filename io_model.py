@@ -0,0 +1,36 @@
+class DeviceModel():
+    """ first-order storage device model: every read request pays a fixed access latency plus its
+        transfer time, and the request rate can't exceed the device's IOPS
+    """
+
+    def __init__(self, name: str, latency: float, iops: float, bandwidth: float):
+        self.name = name
+        self.latency = latency # seconds per request (seek + rotation on an HDD)
+        self.iops = iops # requests per second
+        self.bandwidth = bandwidth # bytes per second
+
+    def io_seconds(self, requests: int, nbytes: int) -> float:
+        """ estimated time to serve requests reads totalling nbytes, one at a time """
+        return max(requests * self.latency + nbytes / self.bandwidth, requests / self.iops)
+
+    def to_string(self) -> str:
+        return f"{self.name} (latency={self.latency * 1e6:.0f}us, iops={self.iops:.0f}, bandwidth={self.bandwidth / 1e6:.0f}MB/s)"
+
+
+DRAM = DeviceModel('dram', latency=100e-9, iops=1e8, bandwidth=20e9)
+NVME = DeviceModel('nvme', latency=80e-6, iops=500000, bandwidth=3.0e9)
+SATA_SSD = DeviceModel('sata_ssd', latency=150e-6, iops=90000, bandwidth=550e6)
+HDD = DeviceModel('hdd', latency=8e-3, iops=150, bandwidth=160e6)
+# object storage over the network: time to first byte dominates, throughput per request stream is modest
+REMOTE = DeviceModel('remote', latency=20e-3, iops=5500, bandwidth=100e6)
+
+DEVICES = {device.name: device for device in (DRAM, NVME, SATA_SSD, HDD, REMOTE)}
+
+def tiered_io_seconds(tiers: dict, misses: int, nbytes: int, backing: DeviceModel, bytes_per_unit: float = 1) -> float:
+    """ estimated time of a cache hierarchy's reads: each tier's hits on its device (tiers is TieredCache.tier_stats(), in units
+        of bytes_per_unit) plus the misses on device. Writes filling the tiers are assumed off the query path
+    """
+    seconds = backing.io_seconds(misses, nbytes)
+    for name, hits, read in zip(tiers['devices'], tiers['hits'], tiers['read']):
+        seconds += DEVICES[name].io_seconds(hits, read * bytes_per_unit)
+    return seconds
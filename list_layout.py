@@ -0,0 +1,181 @@
+import os
+import numpy as np
+import numpy.typing as npt
+import pin_planner
+import probe_trace
+import utils
+
+# layouts the on-disk lists can be written in: list id order, co-access chains, centroid-space recursive bisection
+LAYOUTS = ('id', 'graph', 'bisection')
+# probes of a query at most this many ranks apart count as co-accessed
+COACCESS_SPAN = 8
+
+def coaccess_edges(trace: npt.NDArray, nlist: int, span: int = COACCESS_SPAN) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+    """ returns the list co-access graph of an nq x nprobe trace as (a, b, weight) edge arrays with a < b,
+        weight = number of queries probing both a and b at most span ranks apart. Counted chunk by chunk
+    """
+    keys = np.empty(0, dtype=np.int64)
+    weights = np.empty(0, dtype=np.int64)
+    for _, rows in probe_trace.trace_chunks(trace):
+        rows = rows.astype(np.int64)
+        pairs = []
+        for gap in range(1, min(span, rows.shape[1] - 1) + 1):
+            a = np.minimum(rows[:, :-gap], rows[:, gap:])
+            b = np.maximum(rows[:, :-gap], rows[:, gap:])
+            pairs.append((a * nlist + b).ravel())
+        if not pairs:
+            # a single probe per query co-accesses nothing
+            continue
+        chunk_keys, chunk_weights = np.unique(np.concatenate(pairs), return_counts=True)
+        keys, inverse = np.unique(np.concatenate((keys, chunk_keys)), return_inverse=True)
+        weights = np.bincount(inverse, weights=np.concatenate((weights, chunk_weights)), minlength=len(keys)).astype(np.int64)
+    return keys // nlist, keys % nlist, weights
+
+def chain_order(a: npt.NDArray, b: npt.NDArray, weights: npt.NDArray, frequencies: npt.NDArray) -> npt.NDArray:
+    """ orders the lists so co-accessed lists are neighbors: the heaviest edges join chain ends first (Pettis-Hansen style),
+        then the chains are laid out hottest first
+    """
+    nlist = len(frequencies)
+    parent = list(range(nlist))
+    neighbors = [[] for _ in range(nlist)]
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    order = np.argsort(-weights, kind='stable')
+    for u, v in zip(a[order].tolist(), b[order].tolist()):
+        if len(neighbors[u]) < 2 and len(neighbors[v]) < 2:
+            root_u, root_v = find(u), find(v)
+            if root_u != root_v:
+                parent[root_u] = root_v
+                neighbors[u].append(v)
+                neighbors[v].append(u)
+
+    # every chain is a path, walk each one from an end
+    chains = []
+    seen = [False] * nlist
+    for end in range(nlist):
+        if seen[end] or len(neighbors[end]) == 2:
+            continue
+        chain = []
+        previous, current = -1, end
+        while current != -1:
+            seen[current] = True
+            chain.append(current)
+            following = [x for x in neighbors[current] if x != previous]
+            previous, current = current, following[0] if following else -1
+        chains.append(chain)
+    chains.sort(key=lambda chain: -int(frequencies[chain].sum()))
+    return np.array([cid for chain in chains for cid in chain], dtype=np.int64)
+
+def bisection_order(centroids: npt.NDArray) -> npt.NDArray:
+    """ orders the lists by recursively splitting their centroids at the median of the dimension with the
+        largest variance, so lists close in centroid space end up close on disk
+    """
+    order = []
+
+    def split(ids: npt.NDArray) -> None:
+        if len(ids) <= 2:
+            order.extend(ids.tolist())
+            return
+        points = centroids[ids]
+        values = points[:, int(points.var(axis=0).argmax())]
+        half = len(ids) // 2
+        below = np.argpartition(values, half)
+        split(ids[below[:half]])
+        split(ids[below[half:]])
+
+    split(np.arange(len(centroids)))
+    return np.array(order, dtype=np.int64)
+
+def layout_name(layout: str, nprobe: int) -> str:
+    """ returns the name of a layout's files, the 'graph' order depends on the nprobe it was profiled at """
+    return f'graph.nprobe{nprobe}' if layout == 'graph' else layout
+
+def order_path(index, layout: str, nprobe: int) -> str:
+    return index.sidecar_path(f'layout_order.{layout_name(layout, nprobe)}')
+
+def get_layout_order(index, layout: str, nprobe: int) -> npt.NDArray:
+    """ returns the (persisted) order to write the lists of index in for a layout, the 'graph' layout
+        is built from the probe trace of the profiled xt queries at nprobe
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f'unknown layout {layout}, expected one of {LAYOUTS}')
+    nlist = index.index_ivf.nlist
+    path = order_path(index, layout, nprobe)
+    if not os.path.isfile(path):
+        print(f"Computing {layout} list layout {path}...")
+        if layout == 'graph':
+            trace = index.get_trace(nprobe, pin_planner.profile_queries(index))
+            a, b, weights = coaccess_edges(trace, nlist)
+            order = chain_order(a, b, weights, pin_planner.access_frequencies(trace, nlist))
+        elif layout == 'bisection':
+            order = bisection_order(index.centroids)
+        else:
+            order = np.arange(nlist, dtype=np.int64)
+        utils.save_npy(path, order)
+    return np.load(path)
+
+def layout_offsets(list_bytes: npt.NDArray, order: npt.NDArray) -> npt.NDArray:
+    """ returns the byte offset of every list (indexed by list id) when the lists, each taking list_bytes,
+        are written back to back in order
+    """
+    list_bytes = np.asarray(list_bytes, dtype=np.int64)
+    order = np.asarray(order)
+    offsets = np.zeros(len(list_bytes), dtype=np.int64)
+    offsets[order] = np.cumsum(list_bytes[order]) - list_bytes[order]
+    return offsets
+
+def read_runs(cids: list[int], offsets: list[int], lengths: list[int], max_gap: int = 0) -> list[tuple[int, int]]:
+    """ merges the reads of lists cids into runs of lists at most max_gap bytes apart on disk,
+        returns the (offset, length) of each run, gaps inside a run are read too
+    """
+    runs = []
+    for cid in sorted(set(cids), key=lambda x: offsets[x]):
+        if lengths[cid] == 0:
+            continue
+        if runs and offsets[cid] - (runs[-1][0] + runs[-1][1]) <= max_gap:
+            runs[-1] = (runs[-1][0], offsets[cid] + lengths[cid] - runs[-1][0])
+        else:
+            runs.append((offsets[cid], lengths[cid]))
+    return runs
+
+def replay_layout(cache, trace: npt.NDArray, offsets: npt.NDArray, lengths: npt.NDArray, max_gap: int = 0):
+    """ replays an nq x nprobe trace through cache merging each query's misses into read runs, yields the running
+        statistics of probe_trace.stream_simulation plus the runs and their bytes after each chunk
+    """
+    offsets = np.asarray(offsets).tolist()
+    lengths = np.asarray(lengths).tolist()
+    total_runs = 0
+    total_bytes = 0
+    accesses = 0
+    for start, rows in probe_trace.trace_chunks(trace):
+        hits = cache.num_hits()
+        misses = cache.num_misses()
+        for probes in rows.tolist():
+            missed = []
+            for cid in probes:
+                before = cache.num_misses()
+                cache.access_item(cid)
+                if cache.num_misses() != before:
+                    missed.append(cid)
+            runs = read_runs(missed, offsets, lengths, max_gap)
+            total_runs += len(runs)
+            total_bytes += sum(length for _, length in runs)
+        accesses += rows.size
+        window_hits = cache.num_hits() - hits
+        window_accesses = window_hits + cache.num_misses() - misses
+        yield {
+            'queries': start + len(rows),
+            'accesses': accesses,
+            'hits': cache.num_hits(),
+            'misses': cache.num_misses(),
+            'read': cache.num_vectors_read(),
+            'hit_ratio': cache.num_hits() / max(cache.num_hits() + cache.num_misses(), 1),
+            'window_hit_ratio': window_hits / max(window_accesses, 1),
+            'runs': total_runs,
+            'bytes': total_bytes,
+        }
@@ -1,7 +1,12 @@
 import utils
 import index
-from cache import LRUCache, PinCache, RandomCache
+from cache import LRUCache, PinCache, RandomCache, LFUCache, ARCCache, TwoQCache, S3FIFOCache, WTinyLFUCache, GDSFCache, PagedCache, TieredCache
 import numpy as np
+from query_scheduler import QuerySchedule
+from cache_aware_probe import CacheAwareProbe
+from workload import Workload
+from partitioning import Partitioning
+from sharding import Sharding
 from test_runner import TestRunner
 
 def main():
@@ -73,6 +78,104 @@ def main():
         # 'sift': {
         #     'n_clusters': [131072],
         #     'caches': [
+        #         LRUCache(capacity=100000),
+        #         LFUCache(capacity=100000),
+        #         ARCCache(capacity=100000),
+        #         TwoQCache(capacity=100000),
+        #         S3FIFOCache(capacity=100000),
+        #         WTinyLFUCache(capacity=100000),
+        #         GDSFCache(capacity=100000),
+        #         GDSFCache(capacity=100000, size_cost=True),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [2048],
+        #     'caches': [
+        #         # admit and evict 64 vector pages instead of whole lists, optionally only the head of each list
+        #         PagedCache(LRUCache(capacity=100000), page_size=64),
+        #         PagedCache(LRUCache(capacity=100000), page_size=64, head_pages=8),
+        #         PagedCache(ARCCache(capacity=100000), page_size=256),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     # spread the lists over nodes, each running its own copy of every cache
+        #     'shardings': [None, Sharding(8, 'random'), Sharding(8, 'balanced'), Sharding(8, 'coaccess'), Sharding(32, 'coaccess')],
+        #     'caches': [
+        #         LRUCache(capacity=100000),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     'caches': [
+        #         # DRAM in front of a local NVMe cache in front of object storage (TestRunner(device='remote')),
+        #         # how much NVMe saves DRAM at the same expected io_ms_per_query
+        #         TieredCache([LRUCache(capacity=100000), LRUCache(capacity=1000000)], devices=['dram', 'nvme']),
+        #         TieredCache([LRUCache(capacity=50000), LRUCache(capacity=2000000)], devices=['dram', 'nvme']),
+        #         TieredCache([ARCCache(capacity=50000), S3FIFOCache(capacity=2000000)], devices=['dram', 'nvme'], inclusive=False),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     # compare standard k-means lists against lists split at 2x / 4x the mean list size
+        #     'partitionings': [None, Partitioning(max_factor=2), Partitioning(max_factor=4)],
+        #     'caches': [
+        #         LRUCache(capacity=100000),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     # replay a skewed, bursty 1M query stream built from xq instead of xq itself
+        #     'workload': Workload(n_queries=1000000, zipf=1.0, repeat_prob=0.1, burst_share=0.3, noise=0.01, seed=0),
+        #     'caches': [
+        #         LRUCache(capacity=100000),
+        #         LRUCache(capacity=500000),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     # compare the global nprobe against per-query adaptive probing at the same recall target
+        #     # CacheAwareProbe swaps the last tail probes for resident near-tie lists
+        #     'probing': ['fixed', 'adaptive', CacheAwareProbe(slack=0.05, tail=2)],
+        #     'caches': [
+        #         LRUCache(capacity=100000),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     # replay the queries reordered within batch windows, one cell per schedule
+        #     'schedules': [
+        #         None,
+        #         QuerySchedule('list_major', window=16),
+        #         QuerySchedule('list_major', window=64),
+        #         QuerySchedule('list_major', window=256),
+        #         QuerySchedule('sorted', window=256),
+        #     ],
+        #     'caches': [
+        #         LRUCache(capacity=100000),
+        #     ]
+        # },
+        # 'sift': {
+        #     # any index_factory strings next to (or instead of) n_clusters, e.g. compressed codes,
+        #     # ',RFlat' adds a refine stage whose raw vector fetches go through refine_cache
+        #     'index_types': ['IVF131072,PQ32', 'IVF131072,SQ8', 'IVF131072,RaBitQ', 'IVF131072,PQ32,RFlat'],
+        #     'caches': [
+        #         LRUCache(capacity=100000),
+        #         LRUCache(capacity=500000),
+        #     ],
+        #     'refine_cache': LRUCache(capacity=100000),
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     'caches': [
+        #         # pin lists planned from an xt workload under a budget instead of the largest lists
+        #         PinCache(capacity=500000, pin_budget=100000),
+        #         PinCache(capacity=500000, pin_budget=250000),
+        #     ]
+        # },
+        # 'sift': {
+        #     'n_clusters': [131072],
+        #     'caches': [
         #         PinCache(capacity=10000, pincount=0),
         #         PinCache(capacity=10000, pincount=50),
         #         PinCache(capacity=10000, pincount=100),
@@ -177,6 +280,15 @@ def main():
         },
     }
     
+    # pass lru_curve=True to simulate all LRUCache capacities of a row in one pass, belady=True to fill belady_vectors_read,
+    # workers=N to spread the matrix across N processes,
+    # disk_mode=True (direct_io=True for O_DIRECT) to also measure each cache against the on-disk lists,
+    # and units='bytes' (block_size=...) to size capacities in bytes, device='nvme'/'sata_ssd'/'hdd'/'remote' prices the misses,
+    # layout='id'/'graph'/'bisection' (merge_gap=bytes) costs each query's misses in read runs of the lists stored in that order
+    # (lru_curve is skipped when a layout is set)
+    # (Index.batch_search(nprobe, store=DiskListStore(index)) measures list-major batched execution: lists loaded per batch and QPS)
+    # (Index.concurrent_benchmark([StripedCache(100000, segments=1), StripedCache(100000, segments=16), ClockCache(100000)], nprobe)
+    #  measures throughput scaling, hit ratio and lock wait of thread-safe caches from 1 to 8 serving threads)
     runner = TestRunner(matrix, recall_target=0.9)
     runner.run_testing_matrix()
     # runner.write_results('results.csv')
@@ -0,0 +1,81 @@
+import faiss
+import math
+import numpy as np
+import numpy.typing as npt
+
+class Partitioning():
+    """ index build option capping the lists at max_factor times the mean size: lists over the cap are split by k-means into
+        extra lists (for at most max_rounds rounds) and the index is saved under index_type + suffix()
+    """
+
+    def __init__(self, max_factor: float = 2.0, niter: int = 10, seed: int = 0, max_rounds: int = 10):
+        if max_factor < 1:
+            raise ValueError(f'max_factor must be at least 1, not {max_factor}')
+        self.max_factor = max_factor
+        self.niter = niter
+        self.seed = seed
+        self.max_rounds = max_rounds
+
+    def suffix(self) -> str:
+        return f'.split{self.max_factor:g}'
+
+    def max_list_size(self, n: int, nlist: int) -> int:
+        return max(math.ceil(self.max_factor * n / nlist), 1)
+
+    def check(self, index) -> None:
+        """ raises ValueError if the lists of index can't be split, run before training """
+        if isinstance(index, faiss.IndexPreTransform):
+            raise ValueError('partitioning splits lists over the raw vectors, an IVF behind a pretransform is not supported')
+
+    def split_centroids(self, centroids: npt.NDArray, xb: npt.NDArray, assign: npt.NDArray, cap: int, metric_type: int = faiss.METRIC_L2) -> npt.NDArray:
+        """ returns the centroids with every list over cap having its centroid replaced by its first sub-cluster
+            and the others appended, assign is the list of each vector of xb
+        """
+        # inner product quantizers keep unit norm centroids, so their sub-clusters must be normalized too
+        spherical = metric_type == faiss.METRIC_INNER_PRODUCT
+        nlist = len(centroids)
+        sizes = np.bincount(assign, minlength=nlist)
+        order = np.argsort(assign, kind='stable')
+        starts = np.cumsum(sizes) - sizes
+        extra = []
+        for cid in np.flatnonzero(sizes > cap).tolist():
+            points = np.ascontiguousarray(xb[order[starts[cid]:starts[cid] + sizes[cid]]], dtype=np.float32)
+            kmeans = faiss.Kmeans(points.shape[1], math.ceil(sizes[cid] / cap), niter=self.niter, seed=self.seed, spherical=spherical)
+            kmeans.train(points)
+            centroids[cid] = kmeans.centroids[0]
+            extra.append(kmeans.centroids[1:])
+        print(f"Split {len(extra)} lists over {cap} vectors into {sum(len(x) for x in extra) + len(extra)} lists")
+        return np.concatenate([centroids] + extra).astype(np.float32)
+
+    def apply(self, index, xt: npt.NDArray, xb: npt.NDArray):
+        """ splits the oversized lists of a trained, still empty index in place (its IVF's quantizer and
+            inverted lists), then retrains the encoder of a compressed IVF against the split centroids
+        """
+        self.check(index)
+        index_ivf = faiss.extract_index_ivf(index)
+        quantizer = index_ivf.quantizer
+        cap = self.max_list_size(len(xb), index_ivf.nlist)
+        centroids = quantizer.reconstruct_n(0, index_ivf.nlist).astype(np.float32)
+        for _ in range(self.max_rounds):
+            _, assign = quantizer.search(xb, 1)
+            sizes = np.bincount(assign.ravel(), minlength=len(centroids))
+            if sizes.max() <= cap:
+                break
+            centroids = self.split_centroids(centroids, xb, assign.ravel(), cap, index_ivf.metric_type)
+            quantizer.reset()
+            quantizer.add(centroids)
+        else:
+            _, assign = quantizer.search(xb, 1)
+            sizes = np.bincount(assign.ravel(), minlength=len(centroids))
+            print(f"{int((sizes > cap).sum())} lists are still over {cap} vectors after {self.max_rounds} rounds, the largest has {sizes.max()}")
+        invlists = faiss.ArrayInvertedLists(len(centroids), index_ivf.code_size)
+        index_ivf.replace_invlists(invlists, True)
+        invlists.this.disown()
+        index_ivf.nlist = len(centroids)
+        if not isinstance(index_ivf, faiss.IndexIVFFlat):
+            # the quantizer holds nlist centroids, so train only fits the encoder (and its precomputed tables) again
+            index_ivf.is_trained = False
+            index_ivf.train(xt)
+
+    def to_string(self) -> str:
+        return f"split (max_factor={self.max_factor})"
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import numpy.typing as npt
+import utils
+
+# number of xt vectors profiled as the training query workload
+PROFILE_QUERIES = 10000
+
+def profile_queries(index) -> npt.NDArray:
+    """ returns the training workload the pin plan is profiled on, a slice of xt disjoint from xq\n
+        GloVe has no separate training set (xt is xb), so there the profiled queries are database vectors
+    """
+    return index.xt[:PROFILE_QUERIES]
+
+def access_frequencies(trace: npt.NDArray, nlist: int) -> npt.NDArray:
+    """ returns how many times each list is probed in trace """
+    return np.bincount(np.asarray(trace).ravel(), minlength=nlist)
+
+def plan_pins(frequencies: npt.NDArray, list_sizes: npt.NDArray, budget: int) -> npt.NDArray:
+    """ chooses the lists to pin as a 0/1 knapsack (weight size, value frequency * size) within budget: greedy by
+        frequency then smaller size, swapped for the single most valuable list if that is worth more
+    """
+    frequencies = np.asarray(frequencies, dtype=np.int64)
+    list_sizes = np.asarray(list_sizes, dtype=np.int64)
+    candidates = np.flatnonzero((frequencies > 0) & (list_sizes <= budget))
+    order = candidates[np.lexsort((list_sizes[candidates], -frequencies[candidates]))]
+
+    pinned = []
+    used = 0
+    for cid in order.tolist():
+        if used + list_sizes[cid] <= budget:
+            pinned.append(cid)
+            used += list_sizes[cid]
+    pinned = np.array(pinned, dtype=np.int64)
+
+    values = frequencies * list_sizes
+    if len(candidates) and values[candidates].max() > values[pinned].sum():
+        pinned = candidates[[values[candidates].argmax()]]
+    return pinned
+
+def plan_path(profile_trace_path: str, budget: int, units: str = 'vectors', block_size: int = 4096) -> str:
+    """ the plan of a budget in units ('vectors', or 'bytes' where lists are rounded up to block_size) """
+    weight = f'bytes{block_size}' if units == 'bytes' else 'vectors'
+    return profile_trace_path.replace('.trace.npy', f'.pins{budget}.{weight}.npy')
+
+def get_pin_plan(profile_trace_path: str, list_sizes: npt.NDArray, budget: int, units: str = 'vectors',
+                 block_size: int = 4096) -> npt.NDArray:
+    """ returns the ids of the lists to pin under budget for the profiled trace, list_sizes and budget
+        are in units (see plan_path). The plan is saved next to the trace so later runs pin the same set
+    """
+    path = plan_path(profile_trace_path, budget, units, block_size)
+    if not os.path.isfile(path):
+        print(f"Planning pinned lists {path}...")
+        trace = np.load(profile_trace_path, mmap_mode='r')
+        frequencies = access_frequencies(trace, len(list_sizes))
+        utils.save_npy(path, plan_pins(frequencies, list_sizes, budget))
+    return np.load(path)
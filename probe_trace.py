@@ -0,0 +1,119 @@
+import hashlib
+import os
+import numpy as np
+import numpy.typing as npt
+import utils
+
+# number of queries handed to the cache at a time when replaying a trace
+REPLAY_CHUNK = 1024
+# number of queries whose probes are computed at a time, bounds the memory of long traces
+STREAM_CHUNK = 65536
+
+def query_set_key(queries: npt.NDArray) -> str:
+    """ short digest identifying a query set, so traces of different query sets never collide """
+    queries = np.ascontiguousarray(queries)
+    digest = hashlib.sha1(str(queries.shape).encode())
+    digest.update(queries.tobytes())
+    return digest.hexdigest()[:12]
+
+def trace_path(index, nprobe: int, queries: npt.NDArray) -> str:
+    """ returns indexes/<dataset>/<index_type>.nprobe<nprobe>.<query set>.trace.npy """
+    return f'indexes/{index.dataset}/{index.index_type}.nprobe{nprobe}.{query_set_key(queries)}.trace.npy'
+
+def get_trace(index, nprobe: int, queries: npt.NDArray = None) -> npt.NDArray:
+    """ returns the nq x nprobe int32 array of centroids probed by each query, persisted next to the index
+        and memory-mapped read-only afterwards, so other runs and processes share it
+    """
+    if queries is None:
+        queries = index.xq
+    path = trace_path(index, nprobe, queries)
+    if not os.path.isfile(path):
+        print(f"Computing probe trace {path}...")
+        save_probes(path, stream_probes(index, nprobe, query_chunks(queries)), len(queries), nprobe)
+    return np.load(path, mmap_mode='r')
+
+def query_chunks(queries: npt.NDArray, chunk_size: int = STREAM_CHUNK):
+    """ yields (start, queries) chunks of chunk_size queries """
+    for start in range(0, len(queries), chunk_size):
+        yield start, queries[start:start + chunk_size]
+
+def stream_probes(index, nprobe: int, chunks):
+    """ yields (start, nprobe closest centroids of each query) for every (start, queries) chunk of chunks,
+        e.g. query_chunks or a Workload stream
+    """
+    for start, queries in chunks:
+        yield start, index.find_nearest_centroids(nprobe, queries).astype(np.int32)
+
+def save_probes(path: str, probe_chunks, n_queries: int, nprobe: int) -> None:
+    """ writes streamed probe chunks straight into a memory-mapped n_queries x nprobe int32 .npy at path,
+        through a temporary file like utils.save_npy
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    trace = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int32, shape=(n_queries, nprobe))
+    for start, probes in probe_chunks:
+        trace[start:start + len(probes)] = probes
+    trace.flush()
+    del trace
+    os.replace(tmp_path, path)
+
+def trace_chunks(trace: npt.NDArray, chunk_size: int = STREAM_CHUNK):
+    """ yields (start, rows) chunks of a (memory-mapped) trace, rows are loaded one chunk at a time """
+    for start in range(0, len(trace), chunk_size):
+        yield start, np.asarray(trace[start:start + chunk_size])
+
+def probed_lists(trace: npt.NDArray, nlist: int) -> npt.NDArray:
+    """ returns the ids of the lists probed at least once in trace, counted chunk by chunk """
+    counts = np.zeros(nlist, dtype=np.int64)
+    for _, rows in trace_chunks(trace):
+        counts += np.bincount(rows.ravel(), minlength=nlist)
+    return np.flatnonzero(counts)
+
+def stream_simulation(cache, probe_chunks, bytes_per_unit: int = 1):
+    """ feeds the (start, probes) chunks to cache one at a time, so memory stays bounded, and yields after each the
+        queries, accesses, hits, misses, units and bytes read so far with the overall and last chunk hit ratios
+    """
+    queries = 0
+    accesses = 0
+    for start, probes in probe_chunks:
+        hits = cache.num_hits()
+        misses = cache.num_misses()
+        replay_trace(cache, probes)
+        queries = start + len(probes)
+        accesses += probes.size
+        window_hits = cache.num_hits() - hits
+        window_accesses = window_hits + cache.num_misses() - misses
+        yield {
+            'queries': queries,
+            'accesses': accesses,
+            'hits': cache.num_hits(),
+            'misses': cache.num_misses(),
+            'read': cache.num_vectors_read(),
+            'bytes_read': cache.num_vectors_read() * bytes_per_unit,
+            'hit_ratio': cache.num_hits() / max(cache.num_hits() + cache.num_misses(), 1),
+            'window_hit_ratio': window_hits / max(window_accesses, 1),
+        }
+
+def refine_trace_path(index, nprobe: int, queries: npt.NDArray) -> str:
+    return trace_path(index, nprobe, queries).replace('.trace.npy', '.refine.npy')
+
+def get_refine_trace(index, nprobe: int, queries: npt.NDArray = None) -> npt.NDArray:
+    """ returns the 1D int64 array of vector ids the refine stage fetches, query by query (the k_factor best
+        candidates of the IVF search, padding dropped), persisted and memory-mapped like get_trace
+    """
+    if queries is None:
+        queries = index.xq
+    path = refine_trace_path(index, nprobe, queries)
+    if not os.path.isfile(path):
+        print(f"Computing refine trace {path}...")
+        index.index_ivf.nprobe = nprobe
+        _, candidates = index.index_ivf.search(queries, index.index.k_factor)
+        candidates = candidates.ravel()
+        utils.save_npy(path, candidates[candidates >= 0].astype(np.int64))
+    return np.load(path, mmap_mode='r')
+
+def replay_trace(cache, trace: npt.NDArray) -> None:
+    """ feeds every probe of trace to cache in order, reading the buffer chunk by chunk """
+    for start in range(0, len(trace), REPLAY_CHUNK):
+        for cid in trace[start:start + REPLAY_CHUNK].ravel().tolist():
+            cache.access_item(cid)
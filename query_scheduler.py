@@ -0,0 +1,65 @@
+import numpy as np
+import numpy.typing as npt
+
+class QuerySchedule():
+    """ reorders the probe trace of a serving batch in windows of `window` queries before it reaches the cache: 'fifo'
+        keeps it, 'list_major' visits every probed list once in a row, 'sorted' runs queries with the same nearest lists together
+    """
+
+    METHODS = ('fifo', 'list_major', 'sorted')
+
+    def __init__(self, method: str = 'list_major', window: int = 64):
+        if method not in self.METHODS:
+            raise ValueError(f'unknown schedule method {method}, expected one of {self.METHODS}')
+        self.method = method
+        self.window = window
+
+    def apply(self, trace: npt.NDArray, lengths: npt.NDArray = None) -> tuple[npt.NDArray, npt.NDArray]:
+        """ returns the reordered 1D list visits of trace and the query each belongs to, trace is nq x nprobe
+            or the 1D concatenated visits of queries probing lengths lists each
+        """
+        trace = np.asarray(trace)
+        if lengths is None:
+            lengths = np.full(len(trace), trace.shape[1])
+        lengths = np.asarray(lengths, dtype=np.int64)
+        n = len(lengths)
+        visits = trace.ravel()
+        queries = np.repeat(np.arange(n), lengths)
+        starts = np.cumsum(lengths) - lengths
+        if self.method == 'list_major':
+            order = np.lexsort((visits, queries // self.window))
+        elif self.method == 'sorted':
+            # rows padded with -1 so queries probing fewer lists sort by the lists they do probe
+            padded = np.full((n, int(lengths.max())), fill_value=-1, dtype=np.int64)
+            padded[queries, np.arange(len(visits)) - starts[queries]] = visits
+            keys = tuple(padded[:, j] for j in reversed(range(padded.shape[1]))) + (np.arange(n) // self.window,)
+            query_order = np.lexsort(keys)
+            counts = lengths[query_order]
+            order = np.repeat(starts[query_order], counts) + np.arange(len(visits)) - np.repeat(np.cumsum(counts) - counts, counts)
+        else:
+            order = np.arange(len(visits))
+        return visits[order], queries[order]
+
+    def trace_path(self, path: str) -> str:
+        """ path of the scheduled version of the trace saved at path """
+        return path.replace('.trace.npy', f'.{self.method}{self.window}.trace.npy')
+
+    def to_string(self) -> str:
+        return f"{self.method} (window={self.window})"
+
+def latency_penalty(queries: npt.NDArray, window: int) -> npt.NDArray:
+    """ returns how many list visits later each query completes under the schedule than one by one in arrival order,
+        queries arrive as fast as their visits are served and a window starts once its last query has arrived
+    """
+    queries = np.asarray(queries)
+    n = int(queries.max()) + 1
+    lengths = np.bincount(queries, minlength=n)
+    arrivals = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    last_visit = np.zeros(n, dtype=np.int64)
+    np.maximum.at(last_visit, queries, np.arange(len(queries)))
+
+    window_first = (np.arange(n) // window) * window
+    window_last = np.minimum(window_first + window, n) - 1
+    # windows stay contiguous in the schedule, a window's visits start at its first query's arrival in visits
+    completion = arrivals[window_last] + (last_visit - arrivals[window_first]) + 1
+    return completion - (arrivals + lengths)
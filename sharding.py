@@ -0,0 +1,116 @@
+import copy
+import heapq
+import os
+import numpy as np
+import numpy.typing as npt
+from cache import Cache
+import io_model
+import list_layout
+import probe_trace
+import utils
+
+class Sharding():
+    """ spreads the inverted lists over n_shards nodes with a cache each, a query's probes fan out to the nodes of its lists:
+        'random', 'balanced' (largest first on the lightest node) or 'coaccess' (runs of the list_layout 'graph' order)
+    """
+
+    PLACEMENTS = ('random', 'balanced', 'coaccess')
+
+    def __init__(self, n_shards: int, placement: str = 'balanced', seed: int = 0):
+        if placement not in self.PLACEMENTS:
+            raise ValueError(f'unknown placement {placement}, expected one of {self.PLACEMENTS}')
+        self.n_shards = n_shards
+        self.placement = placement
+        self.seed = seed
+
+    def place(self, list_sizes: npt.NDArray, order: npt.NDArray = None) -> npt.NDArray:
+        """ returns the shard of every list, order is the co-access order of the 'coaccess' placement """
+        list_sizes = np.asarray(list_sizes, dtype=np.int64)
+        if self.placement == 'random':
+            return np.random.default_rng(self.seed).integers(self.n_shards, size=len(list_sizes)).astype(np.int32)
+        shards = np.empty(len(list_sizes), dtype=np.int32)
+        if self.placement == 'balanced':
+            loads = [(0, shard) for shard in range(self.n_shards)]
+            for cid in np.argsort(-list_sizes, kind='stable').tolist():
+                load, shard = heapq.heappop(loads)
+                shards[cid] = shard
+                heapq.heappush(loads, (load + int(list_sizes[cid]), shard))
+            return shards
+        sizes = list_sizes[order]
+        before = np.cumsum(sizes) - sizes
+        shards[order] = np.minimum(before * self.n_shards // max(int(sizes.sum()), 1), self.n_shards - 1)
+        return shards
+
+    def to_string(self) -> str:
+        return f"{self.n_shards} shards ({self.placement})"
+
+def shard_map_path(index, sharding: Sharding, nprobe: int) -> str:
+    name = f'shards{sharding.n_shards}.{sharding.placement}'
+    if sharding.placement == 'random':
+        name += f'.seed{sharding.seed}'
+    elif sharding.placement == 'coaccess':
+        name += f'.nprobe{nprobe}'
+    return index.sidecar_path(name)
+
+def get_shard_map(index, sharding: Sharding, nprobe: int) -> npt.NDArray:
+    """ returns the (persisted) shard of every list of index, the 'coaccess' placement uses the
+        list_layout graph order built from the profiled xt probes at nprobe
+    """
+    path = shard_map_path(index, sharding, nprobe)
+    if not os.path.isfile(path):
+        print(f"Placing lists on {sharding.to_string()} {path}...")
+        order = list_layout.get_layout_order(index, 'graph', nprobe) if sharding.placement == 'coaccess' else None
+        utils.save_npy(path, sharding.place(index.get_list_sizes(), order))
+    return np.load(path)
+
+def shard_caches(cache: Cache, n_shards: int) -> list[Cache]:
+    """ one copy of cache per node, each with the full capacity of cache """
+    return [copy.deepcopy(cache) for _ in range(n_shards)]
+
+def simulate_shards(caches: list[Cache], trace: npt.NDArray, shard_of: npt.NDArray, device: io_model.DeviceModel,
+                    bytes_per_unit: float = 1) -> dict:
+    """ replays an nq x nprobe trace routing every probe to the set up cache of its list's node, a query waits for its
+        slowest node. Returns per node counts, load imbalance, fan-out and latency percentiles next to the totals
+    """
+    shard_of = np.asarray(shard_of)
+    n_shards = len(caches)
+    flat = np.asarray(trace).ravel()
+    for shard, cache in enumerate(caches):
+        # offline policies see the part of the trace their node serves
+        if cache.offline:
+            cache.observe_trace(flat[shard_of[flat] == shard])
+    shard_list = shard_of.tolist()
+    fanout = np.zeros(len(trace), dtype=np.int32)
+    latencies = np.zeros(len(trace))
+    for start, rows in probe_trace.trace_chunks(trace):
+        for q, probes in enumerate(rows.tolist(), start):
+            misses = {} # shard -> (misses, units read) of this query
+            for cid in probes:
+                shard = shard_list[cid]
+                cache = caches[shard]
+                before = (cache.num_misses(), cache.num_vectors_read())
+                cache.access_item(cid)
+                query_misses, query_read = misses.get(shard, (0, 0))
+                misses[shard] = (query_misses + cache.num_misses() - before[0], query_read + cache.num_vectors_read() - before[1])
+            fanout[q] = len(misses)
+            latencies[q] = max(device.io_seconds(n, read * bytes_per_unit) for n, read in misses.values())
+
+    hits = [cache.num_hits() for cache in caches]
+    misses = [cache.num_misses() for cache in caches]
+    read = [cache.num_vectors_read() for cache in caches]
+    accesses = [h + m for h, m in zip(hits, misses)]
+    return {
+        'hits': sum(hits),
+        'misses': sum(misses),
+        'read': sum(read),
+        'node_accesses': accesses,
+        'node_hit_ratio': [h / max(a, 1) for h, a in zip(hits, accesses)],
+        'node_read': read,
+        'load_imbalance': float(max(read) / np.mean(read)) if sum(read) else 1.0,
+        'access_imbalance': float(max(accesses) / np.mean(accesses)) if sum(accesses) else 1.0,
+        'fanout_mean': float(fanout.mean()),
+        'fanout_p99': float(np.percentile(fanout, 99)),
+        'latency_p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'latency_p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'n_shards': n_shards,
+    }
@@ -0,0 +1,101 @@
+import numpy as np
+import numpy.typing as npt
+
+COLD_MISS = np.iinfo(np.int64).max
+
+def previous_access(trace: npt.NDArray) -> npt.NDArray:
+    """ for each position in trace returns the position of the previous access to the same cid,
+        or -1 if it is the first access
+    """
+    order = np.argsort(trace, kind='stable')
+    prev = np.full(len(trace), fill_value=-1, dtype=np.int64)
+    same = trace[order[1:]] == trace[order[:-1]]
+    prev[order[1:][same]] = order[:-1][same]
+    return prev
+
+def next_access(trace: npt.NDArray) -> npt.NDArray:
+    """ for each position in trace returns the position of the next access to the same cid,
+        or len(trace) if it is never accessed again
+    """
+    order = np.argsort(trace, kind='stable')
+    nxt = np.full(len(trace), fill_value=len(trace), dtype=np.int64)
+    same = trace[order[1:]] == trace[order[:-1]]
+    nxt[order[:-1][same]] = order[1:][same]
+    return nxt
+
+def dominance_sums(keys: npt.NDArray, weights: npt.NDArray, x: npt.NDArray, y: npt.NDArray) -> npt.NDArray:
+    """ for every query i returns sum(weights[j] for j < x[i] if keys[j] < y[i]),
+        an offline Fenwick tree answering each level of dyadic blocks with one sort + searchsorted, O(n log^2 n)
+    """
+    n = len(keys)
+    span = n + 1 # keys are in [-1, n), shifted by one they fit in [0, span)
+    positions = np.arange(n, dtype=np.int64)
+    out = np.zeros(len(x), dtype=np.int64)
+    level = 0
+    while (1 << level) <= n:
+        block_of = positions >> level
+        combined = block_of * span + (keys + 1)
+        order = np.argsort(combined, kind='stable')
+        combined = combined[order]
+        csum = np.concatenate(([0], np.cumsum(weights[order])))
+
+        # queries whose x has this bit set own the block [x with low bits cleared, + 2^level)
+        has_block = ((x >> level) & 1).astype(bool)
+        block = (x[has_block] >> level) - 1
+        start = np.searchsorted(combined, block * span, side='left')
+        end = np.searchsorted(combined, block * span + (y[has_block] + 1), side='left')
+        out[has_block] += csum[end] - csum[start]
+        level += 1
+    return out
+
+def reuse_distances(trace: npt.NDArray, list_sizes: npt.NDArray) -> npt.NDArray:
+    """ returns the size weighted LRU stack distance of every access in trace, COLD_MISS for first accesses,
+        an access is an LRUCache hit iff its distance <= capacity
+    """
+    trace = np.asarray(trace, dtype=np.int64)
+    weights = np.asarray(list_sizes, dtype=np.int64)[trace]
+    prev = previous_access(trace)
+
+    warm = np.flatnonzero(prev >= 0)
+    p = prev[warm]
+    # distinct lists in (p, t) = accesses in (p, t) whose own previous access is before p
+    prefix = np.concatenate(([0], np.cumsum(weights)))
+    window = dominance_sums(prev, weights, warm, p) - prefix[p + 1]
+
+    distances = np.full(len(trace), fill_value=COLD_MISS, dtype=np.int64)
+    distances[warm] = window + weights[warm]
+    return distances
+
+def lru_curve(trace: npt.NDArray, list_sizes: npt.NDArray, capacities: list[int]) -> dict[int, tuple[int, int, int]]:
+    """ returns {capacity: (hits, misses, vectors_read)} of an LRUCache replaying trace, for every capacity """
+    distances = reuse_distances(trace, list_sizes)
+    weights = np.asarray(list_sizes, dtype=np.int64)[np.asarray(trace, dtype=np.int64)]
+    order = np.argsort(distances, kind='stable')
+    sorted_distances = distances[order]
+    hit_weight = np.concatenate(([0], np.cumsum(weights[order])))
+    total_weight = int(hit_weight[-1])
+
+    curve = {}
+    for capacity in capacities:
+        hits = int(np.searchsorted(sorted_distances, capacity, side='right'))
+        curve[capacity] = (hits, len(distances) - hits, total_weight - int(hit_weight[hits]))
+    return curve
+
+def simulate_lru_curve(index, nprobe: int, capacities: list[int]) -> tuple[dict[int, tuple[int, int, int]], int, int]:
+    """ simulates an LRUCache of every capacity in one pass over the probe trace\n
+        returns ({capacity: (hits, misses, vectors_read)}, number of unique centroids, number of unique vectors accessed)
+    """
+    print("Starting LRU curve simulation...")
+    print(f"\tIndex type: {index.index_type}")
+    print(f"\tCapacities: {capacities}")
+    centroid_idxs = np.asarray(index.get_trace(nprobe)).ravel()
+    list_sizes = index.get_list_sizes()
+    curve = lru_curve(centroid_idxs, list_sizes, capacities)
+
+    unique_centroids_accessed = np.unique(centroid_idxs)
+    num_unique_vectors_read = int(list_sizes[unique_centroids_accessed].sum())
+    print('Simulation results:')
+    for capacity, (hits, misses, vectors_read) in curve.items():
+        print(f'\tcapacity={capacity}: {hits} cache hits, {misses} disk reads, {vectors_read} vectors read from disk')
+    print(f'\t({len(unique_centroids_accessed)} disk reads and {num_unique_vectors_read} vectors unavoidable)')
+    return curve, len(unique_centroids_accessed), num_unique_vectors_read
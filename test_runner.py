@@ -1,10 +1,107 @@
 from index import Index
-from cache import Cache, PinCache
+from cache import Cache, LRUCache, PinCache, BeladyCache, TieredCache, PinCapacityError
+from stack_distance import lru_curve
+from disk_store import run_disk_search, BLOCK_SIZE
+from query_scheduler import QuerySchedule, latency_penalty
+import adaptive_probe
+import cache_aware_probe
+import list_layout
+from cache_aware_probe import CacheAwareProbe
+from workload import Workload, workload_trace_path
+from partitioning import Partitioning
+import sharding
+from sharding import Sharding
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import numpy.typing as npt
+import probe_trace
+import pin_planner
+import io_model
 import utils
 import csv
 import os
 import json
 import time
+import gc
+import fcntl
+
+NPROBE_CACHE_FILE = 'nprobe_cache.json'
+# a cell's replay reports its progress every this many accesses
+PROGRESS_ACCESSES = 10000000
+# adaptive probing may visit up to this many times the fixed nprobe lists for a hard query
+ADAPTIVE_MAX_FACTOR = 2
+
+RESULT_COLUMNS = [
+    'dataset',
+    'index_description',
+    'index_centroids',
+    'cache_description',
+    'cache_size',
+    'pin_count',
+    'hits', 
+    'misses', 
+    'vectors_read', 
+    'num_necessary_cluster_reads',
+    'num_necessary_vector_reads',
+    'recall',
+    'nprobe',
+    'belady_vectors_read',
+    'disk_bytes_read',
+    'disk_qps',
+    'latency_p50_ms',
+    'latency_p99_ms',
+    'units',
+    'device',
+    'io_ms_per_query',
+    'refine_hits',
+    'refine_misses',
+    'refine_read',
+    'schedule',
+    'delay_mean_visits',
+    'delay_p99_visits',
+    'probing',
+    'mean_nprobe',
+    'workload',
+    'layout',
+    'read_runs_per_query',
+    'merged_bytes_per_query',
+    'disk_read_requests',
+    'max_list_size',
+    'tier_hits',
+    'tier_read',
+    'tier_filled',
+    'sharding',
+    'fanout_mean',
+    'load_imbalance',
+    'shard_latency_p99_ms'
+]
+
+def factory_string(index_type: str | int) -> str:
+    """ matrix entries are index_factory strings, a bare number of clusters means IVF<n>,Flat """
+    if isinstance(index_type, int):
+        return f'IVF{index_type},Flat'
+    return index_type
+
+def matrix_index_types(submatrix: dict) -> list[str]:
+    """ the index_factory strings of a dataset's submatrix, its 'n_clusters' (Flat IVFs) then its 'index_types' """
+    return [factory_string(x) for x in submatrix.get('n_clusters', [])] + submatrix.get('index_types', [])
+
+def matrix_schedules(submatrix: dict) -> list[QuerySchedule]:
+    """ the query schedules of a dataset's submatrix, None replays queries in their original order """
+    return submatrix.get('schedules', [None])
+
+def matrix_partitionings(submatrix: dict) -> list[Partitioning]:
+    """ the partitionings of a dataset's submatrix, None builds the index as index_factory trains it """
+    return submatrix.get('partitionings', [None])
+
+def matrix_shardings(submatrix: dict) -> list[Sharding]:
+    """ the shardings of a dataset's submatrix, None serves every list from a single node """
+    return submatrix.get('shardings', [None])
+
+def matrix_probings(submatrix: dict) -> list[str | CacheAwareProbe]:
+    """ the probing modes of a dataset's submatrix, 'fixed', 'adaptive' and/or CacheAwareProbes """
+    return submatrix.get('probing', ['fixed'])
 
 class Result():
 
@@ -21,7 +118,36 @@ class Result():
                 num_necessary_cluster_reads,
                 num_necessary_vector_reads,
                 recall,
-                nprobe
+                nprobe,
+                belady_vectors_read,
+                disk_bytes_read=None,
+                disk_qps=None,
+                latency_p50_ms=None,
+                latency_p99_ms=None,
+                units='vectors',
+                device=None,
+                io_ms_per_query=None,
+                refine_hits=None,
+                refine_misses=None,
+                refine_read=None,
+                schedule=None,
+                delay_mean_visits=None,
+                delay_p99_visits=None,
+                probing='fixed',
+                mean_nprobe=None,
+                workload=None,
+                layout=None,
+                read_runs_per_query=None,
+                merged_bytes_per_query=None,
+                disk_read_requests=None,
+                max_list_size=None,
+                tier_hits=None,
+                tier_read=None,
+                tier_filled=None,
+                sharding=None,
+                fanout_mean=None,
+                load_imbalance=None,
+                shard_latency_p99_ms=None
                 ):
         self.dataset = dataset
         self.index_description = index_description
@@ -36,6 +162,47 @@ class Result():
         self.num_necessary_vector_reads = num_necessary_vector_reads
         self.recall = recall
         self.nprobe = nprobe
+        self.belady_vectors_read = belady_vectors_read
+        # only measured in disk mode
+        self.disk_bytes_read = disk_bytes_read
+        self.disk_qps = disk_qps
+        self.latency_p50_ms = latency_p50_ms
+        self.latency_p99_ms = latency_p99_ms
+        # unit of cache_size, vectors_read and the necessary and Belady reads: 'vectors' or 'bytes'
+        self.units = units
+        self.device = device
+        self.io_ms_per_query = io_ms_per_query
+        # only for indexes with a refine stage, counts of the raw vector cache (refine_read is in units)
+        self.refine_hits = refine_hits
+        self.refine_misses = refine_misses
+        self.refine_read = refine_read
+        # query_scheduler schedule the trace was replayed in, and how much later it answers queries, in list visits
+        self.schedule = schedule
+        self.delay_mean_visits = delay_mean_visits
+        self.delay_p99_visits = delay_p99_visits
+        # 'fixed' or the adaptive probing setup, nprobe is then the cap and mean_nprobe the lists probed per query
+        self.probing = probing
+        self.mean_nprobe = mean_nprobe
+        # synthetic query stream replayed instead of xq, recall and nprobe are still those of xq
+        self.workload = workload
+        # list_layout order of the lists on disk, the misses of each query merged into runs of adjacent lists
+        # and the bytes those runs span (only for traces kept per query), disk_read_requests is measured in disk mode
+        self.layout = layout
+        self.read_runs_per_query = read_runs_per_query
+        self.merged_bytes_per_query = merged_bytes_per_query
+        self.disk_read_requests = disk_read_requests
+        # largest inverted list in vectors, what a Partitioning caps
+        self.max_list_size = max_list_size
+        # only for a TieredCache, '/' separated per tier from the top: hits, units served and units written
+        self.tier_hits = tier_hits
+        self.tier_read = tier_read
+        self.tier_filled = tier_filled
+        # only for sharded cells: nodes per query, max over mean units read per node,
+        # and the p99 latency of queries waiting for their slowest node
+        self.sharding = sharding
+        self.fanout_mean = fanout_mean
+        self.load_imbalance = load_imbalance
+        self.shard_latency_p99_ms = shard_latency_p99_ms
 
     def to_row(self) -> list[any]:
         return [
@@ -51,172 +218,678 @@ class Result():
             self.num_necessary_cluster_reads,
             self.num_necessary_vector_reads,
             self.recall,
-            self.nprobe
+            self.nprobe,
+            self.belady_vectors_read,
+            self.disk_bytes_read,
+            self.disk_qps,
+            self.latency_p50_ms,
+            self.latency_p99_ms,
+            self.units,
+            self.device,
+            self.io_ms_per_query,
+            self.refine_hits,
+            self.refine_misses,
+            self.refine_read,
+            self.schedule,
+            self.delay_mean_visits,
+            self.delay_p99_visits,
+            self.probing,
+            self.mean_nprobe,
+            self.workload,
+            self.layout,
+            self.read_runs_per_query,
+            self.merged_bytes_per_query,
+            self.disk_read_requests,
+            self.max_list_size,
+            self.tier_hits,
+            self.tier_read,
+            self.tier_filled,
+            self.sharding,
+            self.fanout_mean,
+            self.load_imbalance,
+            self.shard_latency_p99_ms
         ]
 
+class IndexRegistry():
+    """ loads each dataset once and opens each (dataset, index_type) index once, keyed by Index.index_type,
+        only the dataset currently in use is kept in memory
+    """
+
+    def __init__(self):
+        self.dataset = None
+        self.data = None
+        self.indexes = {}
+
+    def get_index(self, dataset: str, index_type: str, partitioning: Partitioning = None) -> Index:
+        if dataset != self.dataset:
+            self.release()
+            print(f"Loading {dataset}...")
+            self.data = utils.get_dataset(dataset)
+            self.dataset = dataset
+        key = f'{index_type}{partitioning.suffix()}' if partitioning else index_type
+        if key not in self.indexes:
+            xt, xb, xq, gt = self.data
+            self.indexes[key] = Index(dataset, index_type, xt, xb, xq, gt, partitioning)
+        return self.indexes[key]
+
+    def release(self):
+        """ drops the current dataset and all of its indexes """
+        self.dataset = None
+        self.data = None
+        self.indexes = {}
+        gc.collect()
+
+class SharedIndex():
+    """ stand-in for Index when simulating a cell, serves the list sizes and pin plans from memory-mapped
+        files instead of having them pickled over to pool workers
+    """
+
+    def __init__(self, cell: dict):
+        self.cell = cell
+
+    def get_list_sizes(self) -> npt.NDArray:
+        return np.load(self.cell['list_sizes_path'], mmap_mode='r')
+
+    def get_pin_plan(self, budget: int, nprobe: int = None) -> npt.NDArray:
+        """ returns the plan made at the cell's nprobe, which a PinCache's own nprobe can't override """
+        if nprobe is not None and nprobe != self.cell['nprobe']:
+            raise ValueError(f"the pins of this cell are planned at its nprobe={self.cell['nprobe']}, not {nprobe}")
+        return np.load(self.cell['pin_plans'][budget])
+
+def simulate_cell(cell: dict, cache: Cache) -> tuple[int, int, int, dict]:
+    """ replays the cell's memory-mapped trace through cache in a pool worker, returns (hits, misses, vectors_read, extras)
+        or None if its pinned lists don't fit, extras holds the recall, read runs, tier_stats or shard report of the cell's mode
+    """
+    cache.reset()
+    extras = {}
+    try:
+        cache.setup(index=SharedIndex(cell))
+        # the probes of a cache-aware cell depend on the cache, offline caches get the fixed nprobe trace instead
+        if cell.get('cache_aware') and not cache.offline:
+            aware = cell['cache_aware']
+            candidates = np.load(aware['candidates_path'], mmap_mode='r')
+            distances = np.load(aware['distances_path'], mmap_mode='r')
+            trace = cache_aware_probe.replay_cache_aware(cache, aware['probe'], candidates, distances, cell['nprobe'])
+            extras['recall'] = cache_aware_probe.probed_recall(trace, np.load(aware['gt_lists_path']))
+        elif cell.get('sharding'):
+            shards = cell['sharding']
+            caches = sharding.shard_caches(cache, shards['n_shards'])
+            report = sharding.simulate_shards(caches, np.load(cell['trace_path'], mmap_mode='r'), np.load(shards['shard_map_path']),
+                                              io_model.DEVICES[shards['device']], shards['bytes_per_unit'])
+            extras['shards'] = report
+            if isinstance(cache, TieredCache):
+                # the nodes' tiers summed tier by tier
+                stats = [node_cache.tier_stats() for node_cache in caches]
+                extras['tiers'] = dict(stats[0], **{key: [sum(x) for x in zip(*(node[key] for node in stats))] for key in ('hits', 'read', 'filled')})
+            return report['hits'], report['misses'], report['read'], extras
+        else:
+            replay_trace(cell, cache, extras)
+    except PinCapacityError:
+        return None
+    if isinstance(cache, TieredCache):
+        extras['tiers'] = cache.tier_stats()
+    return cache.num_hits(), cache.num_misses(), cache.num_vectors_read(), extras
+
+def replay_trace(cell: dict, cache: Cache, extras: dict) -> None:
+    """ replays the cell's trace in order, reporting its progress every PROGRESS_ACCESSES accesses,
+        and merging each query's misses into read runs when the cell has a layout
+    """
+    trace = np.load(cell['trace_path'], mmap_mode='r')
+    cache.observe_trace(trace)
+    layout = cell.get('layout')
+    if layout and trace.ndim == 2:
+        list_bytes = np.load(layout['list_bytes_path'])
+        offsets = list_layout.layout_offsets(list_bytes, np.load(layout['order_path']))
+        chunks = list_layout.replay_layout(cache, trace, offsets, list_bytes, layout['merge_gap'])
+    else:
+        chunks = probe_trace.stream_simulation(cache, probe_trace.trace_chunks(trace))
+    next_report = PROGRESS_ACCESSES
+    stats = None
+    for stats in chunks:
+        if stats['accesses'] >= next_report:
+            print(f"\t{cache.to_string()}: {stats['accesses']} accesses, hit ratio {stats['hit_ratio']:.4f} ({stats['window_hit_ratio']:.4f} in the last chunk)")
+            next_report += PROGRESS_ACCESSES
+    if stats is not None and 'runs' in stats:
+        extras['read_runs_per_query'] = stats['runs'] / len(trace)
+        extras['merged_bytes_per_query'] = stats['bytes'] / len(trace)
+
+def refine_cache(submatrix: dict) -> Cache:
+    """ the cache the refine fetches of a submatrix go through, its 'refine_cache' or none at all """
+    return submatrix.get('refine_cache') or LRUCache(capacity=0)
+
 class TestRunner():
 
     def __init__(self, 
                 matrix: any,
-                recall_target: float
+                recall_target: float,
+                lru_curve: bool = False,
+                workers: int = 1,
+                disk_mode: bool = False,
+                direct_io: bool = False,
+                units: str = 'vectors',
+                block_size: int = 4096,
+                device: str = 'nvme',
+                layout: str = None,
+                merge_gap: int = 0,
+                belady: bool = False
                 ):
         self.matrix = matrix
         self.recall_target = recall_target
+        # when set, all LRUCaches of a matrix row are simulated in a single pass
+        self.lru_curve = lru_curve
+        # number of processes the matrix cells are spread across
+        self.workers = workers
+        # when set, every cache is also run against the on-disk list layout (optionally with O_DIRECT)
+        # and the measured bytes read, QPS and latencies are reported next to the simulated counts
+        self.disk_mode = disk_mode
+        self.direct_io = direct_io
+        # 'vectors' or 'bytes': in bytes mode lists weigh their on-disk size rounded up to block_size,
+        # so cache capacities, pin budgets and every read count in the results are in bytes
+        self.units = units
+        self.block_size = block_size
+        # io_model device the misses are costed on
+        self.device = io_model.DEVICES[device]
+        # list_layout order the lists are stored in, the misses of a query are read in runs of lists
+        # at most merge_gap bytes apart, and costed as one request per run (None costs one request per miss)
+        if layout is not None and layout not in list_layout.LAYOUTS:
+            raise ValueError(f'unknown layout {layout}, expected one of {list_layout.LAYOUTS}')
+        self.layout = layout
+        self.merge_gap = merge_gap
+        # when set, every cell also replays a BeladyCache per capacity for the belady_vectors_read column
+        self.belady = belady
         self.results = []
+        self.registry = IndexRegistry()
         self.nprobe_cache = {}
         self.filename = ''
-        if os.path.isfile('nprobe_cache.json'):
-            with open('nprobe_cache.json') as f:
+        if os.path.isfile(NPROBE_CACHE_FILE):
+            with open(NPROBE_CACHE_FILE) as f:
                 self.nprobe_cache = json.load(f)
-            
-    def __del__(self):
-        with open('nprobe_cache.json', 'w') as f:
-            json.dump(self.nprobe_cache, f)
+
+    def save_nprobe_cache(self):
+        """ merges our nprobes into nprobe_cache.json under a file lock, so concurrent runners don't clobber each other """
+        with open(f'{NPROBE_CACHE_FILE}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = {}
+            if os.path.isfile(NPROBE_CACHE_FILE):
+                with open(NPROBE_CACHE_FILE) as f:
+                    merged = json.load(f)
+            for dataset, nprobes in self.nprobe_cache.items():
+                merged.setdefault(dataset, {}).update(nprobes)
+            tmp_path = f'{NPROBE_CACHE_FILE}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(merged, f)
+            os.replace(tmp_path, NPROBE_CACHE_FILE)
+            self.nprobe_cache = merged
     
     def run_testing_matrix(self):
         start_time = time.time()
         self.filename = f'results{start_time}.csv'
         with open(self.filename, 'a', newline='') as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow([
-                'dataset',
-                'index_description',
-                'index_centroids',
-                'cache_description',
-                'cache_size',
-                'pin_count',
-                'hits', 
-                'misses', 
-                'vectors_read', 
-                'num_necessary_cluster_reads',
-                'num_necessary_vector_reads',
-                'recall',
-                'nprobe'
-            ])
+            writer.writerow(RESULT_COLUMNS)
+
+        if self.workers > 1 and self.disk_mode:
+            print("Disk mode measures latency, running the matrix serially")
+        elif self.workers > 1:
+            self.run_parallel()
+            return
 
         for dataset in self.matrix.keys():
             submatrix = self.matrix[dataset]
-            for cluster_size in submatrix['n_clusters']:
-                for cache in submatrix['caches']:
-                    self.run_single_sim(dataset, cluster_size, cache)
+            caches = submatrix['caches']
+            refines = {} # refine trace path -> counts, cells of one probing mode share them
+            for cell in self.matrix_cells(dataset, submatrix):
+                refine = None
+                if cell['refine']:
+                    key = cell['refine']['trace_path']
+                    if key not in refines:
+                        refines[key] = simulate_cell(cell['refine'], refine_cache(submatrix))
+                    refine = refines[key]
+                curve = self.run_lru_curve(cell, caches)
+                belady = {}
+                for cache in caches:
+                    if self.belady and cache.capacity not in belady:
+                        belady[cache.capacity] = simulate_cell(cell, BeladyCache(cache.capacity))
+                    counts = curve[cache.capacity] if isinstance(cache, LRUCache) and curve else simulate_cell(cell, cache)
+                    disk = self.run_disk(cell, cache) if counts is not None else None
+                    self.write_cell_result(cell, cache, counts, belady.get(cache.capacity), disk, refine)
+            self.registry.release()
+
+    def run_parallel(self):
+        """ runs the matrix on a pool of self.workers processes, which memory-map the trace and list sizes of each cell
+            prepared by the parent and only simulate the caches. Rows are written in matrix order
+        """
+        # spawn rather than fork, faiss' OpenMP threads don't survive a fork
+        context = multiprocessing.get_context('spawn')
+        pending = [] # (cell, cache, counts or future, belady future, refine future) in matrix order
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            for dataset in self.matrix.keys():
+                submatrix = self.matrix[dataset]
+                caches = submatrix['caches']
+                refines = {} # refine trace path -> future
+                for cell in self.matrix_cells(dataset, submatrix):
+                    refine = None
+                    if cell['refine']:
+                        key = cell['refine']['trace_path']
+                        if key not in refines:
+                            refines[key] = pool.submit(simulate_cell, cell['refine'], refine_cache(submatrix))
+                        refine = refines[key]
+                    curve = self.run_lru_curve(cell, caches)
+                    belady = {}
+                    for cache in caches:
+                        if self.belady and cache.capacity not in belady:
+                            belady[cache.capacity] = pool.submit(simulate_cell, cell, BeladyCache(cache.capacity))
+                        if isinstance(cache, LRUCache) and curve:
+                            counts = curve[cache.capacity]
+                        else:
+                            counts = pool.submit(simulate_cell, cell, cache)
+                        pending.append((cell, cache, counts, belady.get(cache.capacity), refine))
+                self.registry.release()
+
+            for cell, cache, counts, belady, refine in pending:
+                if not isinstance(counts, tuple):
+                    counts = counts.result()
+                self.write_cell_result(cell, cache, counts, belady.result() if belady else None, None, refine.result() if refine else None)
+
+    def matrix_cells(self, dataset: str, submatrix: dict):
+        """ yields the cells of a dataset's submatrix in matrix order, for every index type, partitioning, probing mode, schedule and sharding """
+        for index_type in matrix_index_types(submatrix):
+            for partitioning in matrix_partitionings(submatrix):
+                index_cell = self.prepare_cell(dataset, index_type, submatrix['caches'], partitioning)
+                index_cell = self.workload_cell(index_cell, submatrix.get('workload'))
+                for probing in matrix_probings(submatrix):
+                    if probing != 'fixed' and index_cell['workload']:
+                        print(f"Workloads are replayed with the fixed nprobe, skipping {probing} probing")
+                        continue
+                    probing_cell = self.probing_cell(index_cell, probing)
+                    for schedule in matrix_schedules(submatrix):
+                        if schedule is not None and probing_cell['cache_aware']:
+                            print(f"Cache-aware probing replays queries in arrival order, skipping {schedule.to_string()}")
+                            continue
+                        schedule_cell = self.schedule_cell(probing_cell, schedule)
+                        for shards in matrix_shardings(submatrix):
+                            if shards is not None and (schedule_cell['schedule'] is not None or schedule_cell['probing'] != 'fixed'):
+                                print(f"Sharding routes the fixed nprobe probes of each query, skipping {shards.to_string()} for this cell")
+                                continue
+                            yield self.shard_cell(schedule_cell, shards)
+
+    def prepare_cell(self, dataset: str, index_type: str, caches: list[Cache], partitioning: Partitioning = None) -> dict:
+        """ computes and persists what the caches of a (dataset, index_type, partitioning) cell share, so workers can memory-map it,
+            cell['refine'] is a cell of its own over the raw vectors fetched by the refine stage
+        """
+        ind = self.load_index(dataset, index_type, partitioning)
+        nprobe = self.find_nprobe(ind)
+        trace = ind.get_trace(nprobe)
+        list_sizes_path = ind.sidecar_path('list_sizes')
+        list_sizes = ind.get_list_sizes()
+        if self.units == 'bytes':
+            list_sizes_path = ind.sidecar_path(f'list_bytes{self.block_size}')
+            list_sizes = ind.get_list_bytes(self.block_size)
+            if not os.path.isfile(list_sizes_path):
+                utils.save_npy(list_sizes_path, list_sizes)
+        labels = ind.search(nprobe)
+        unique_centroids_accessed = probe_trace.probed_lists(trace, len(list_sizes))
+        layout = None
+        if self.layout is not None:
+            list_layout.get_layout_order(ind, self.layout, nprobe)
+            layout = {
+                'name': self.layout,
+                'order_path': list_layout.order_path(ind, self.layout, nprobe),
+                'list_bytes_path': ind.sidecar_path(f'list_bytes{BLOCK_SIZE}'),
+                'merge_gap': self.merge_gap,
+            }
+            if not os.path.isfile(layout['list_bytes_path']):
+                utils.save_npy(layout['list_bytes_path'], ind.get_list_bytes(BLOCK_SIZE))
+
+        pin_plans = {}
+        budgets = {x.pin_budget for x in caches if isinstance(x, PinCache) and x.pin_budget is not None}
+        if budgets:
+            profile = pin_planner.profile_queries(ind)
+            ind.get_trace(nprobe, profile)
+            profile_trace_path = probe_trace.trace_path(ind, nprobe, profile)
+            for budget in budgets:
+                pin_planner.get_pin_plan(profile_trace_path, list_sizes, budget, self.units, self.block_size)
+                pin_plans[budget] = pin_planner.plan_path(profile_trace_path, budget, self.units, self.block_size)
+        return {
+            'dataset': dataset,
+            'index_type': ind.index_type,
+            'n_clusters': ind.index_ivf.nlist,
+            'nprobe': nprobe,
+            'trace_path': probe_trace.trace_path(ind, nprobe, ind.xq),
+            'list_sizes_path': list_sizes_path,
+            'bytes_per_vector': ind.index_ivf.code_size + 8,
+            'n_queries': len(trace),
+            'recall': ind.report_recall(labels),
+            'u_centroids': len(unique_centroids_accessed),
+            'u_vectors': int(list_sizes[unique_centroids_accessed].sum()),
+            'max_list_size': int(ind.get_list_sizes().max()),
+            'pin_plans': pin_plans,
+            'refine': self.prepare_refine_cell(ind, nprobe) if ind.has_refine() else None,
+            'schedule': None,
+            'delay_mean': None,
+            'delay_p99': None,
+            'probing': 'fixed',
+            'mean_nprobe': nprobe,
+            'lengths_path': None,
+            'cache_aware': None,
+            'workload': None,
+            'sharding': None,
+            'layout': layout,
+        }
+
+    def workload_cell(self, cell: dict, stream: Workload) -> dict:
+        """ returns the cell replaying the probe trace of a synthetic query stream instead of xq (None keeps xq) """
+        if stream is None:
+            return cell
+        ind = self.load_index(cell['dataset'], cell['index_type'])
+        trace = ind.get_workload_trace(cell['nprobe'], stream)
+        list_sizes = np.load(cell['list_sizes_path'], mmap_mode='r')
+        unique_centroids_accessed = probe_trace.probed_lists(trace, len(list_sizes))
+        return dict(cell,
+                    trace_path=workload_trace_path(ind, cell['nprobe'], stream),
+                    n_queries=stream.n_queries,
+                    u_centroids=len(unique_centroids_accessed),
+                    u_vectors=int(list_sizes[unique_centroids_accessed].sum()),
+                    workload=stream.to_string(),
+                    # the refine candidates were traced for xq
+                    refine=None)
+
+    def probing_cell(self, cell: dict, probing: str | CacheAwareProbe) -> dict:
+        """ returns the cell for a probing mode: 'fixed' nprobe, 'adaptive' within a ratio learned on xt (a 1D trace with
+            a lengths sidecar), or a CacheAwareProbe picking the tail probes during the replay (Flat IVF only)
+        """
+        if probing == 'fixed':
+            return cell
+        ind = self.load_index(cell['dataset'], cell['index_type'])
+        if isinstance(probing, CacheAwareProbe):
+            if not ind.is_flat():
+                raise ValueError(f'cache-aware probing recall is only modelled for Flat IVF, not {ind.index_type}')
+            cache_aware_probe.get_candidates(ind, cell['nprobe'], probing.tail)
+            ind.get_gt_lists()
+            return dict(cell,
+                        probing=probing.to_string(),
+                        cache_aware={
+                            'probe': probing,
+                            'candidates_path': cache_aware_probe.candidates_path(ind, cell['nprobe'], probing.tail),
+                            'distances_path': cache_aware_probe.distances_path(ind, cell['nprobe'], probing.tail),
+                            'gt_lists_path': ind.sidecar_path('gt_lists'),
+                        },
+                        refine=None)
+        if probing != 'adaptive':
+            raise ValueError(f'unknown probing mode {probing}')
+        max_nprobe = min(ADAPTIVE_MAX_FACTOR * cell['nprobe'], ind.index_ivf.nlist)
+        ratio = ind.learn_probe_ratio(max_nprobe, self.recall_target)
+        visits, lengths = ind.get_adaptive_trace(max_nprobe, ratio)
+        labels = ind.adaptive_search(max_nprobe, ratio)
+        list_sizes = np.load(cell['list_sizes_path'], mmap_mode='r')
+        unique_centroids_accessed = probe_trace.probed_lists(visits, len(list_sizes))
+        trace_path = adaptive_probe.adaptive_trace_path(ind, max_nprobe, ratio, ind.xq)
+        print(f"Adaptive probing: ratio={ratio:.4g}, {lengths.mean():.1f} lists per query (max {max_nprobe})")
+        return dict(cell,
+                    trace_path=trace_path,
+                    lengths_path=adaptive_probe.lengths_path(trace_path),
+                    probing=f'adaptive (ratio={ratio:.4g})',
+                    nprobe=max_nprobe,
+                    mean_nprobe=float(lengths.mean()),
+                    recall=ind.report_recall(labels),
+                    u_centroids=len(unique_centroids_accessed),
+                    u_vectors=int(list_sizes[unique_centroids_accessed].sum()),
+                    # the refine candidates were traced with the fixed nprobe
+                    refine=None)
+
+    def schedule_cell(self, cell: dict, schedule: QuerySchedule) -> dict:
+        """ returns the cell with its trace reordered by schedule (None keeps the original order),
+            the scheduled trace and the latency penalty of each query are saved next to the trace
+        """
+        if schedule is None:
+            return cell
+        path = schedule.trace_path(cell['trace_path'])
+        delay_path = path.replace('.trace.npy', '.delay.npy')
+        if not os.path.isfile(path) or not os.path.isfile(delay_path):
+            print(f"Scheduling {cell['trace_path']} {schedule.to_string()}...")
+            lengths = np.load(cell['lengths_path']) if cell['lengths_path'] else None
+            visits, queries = schedule.apply(np.load(cell['trace_path'], mmap_mode='r'), lengths)
+            utils.save_npy(delay_path, latency_penalty(queries, schedule.window))
+            utils.save_npy(path, visits.astype(np.int32))
+        delay = np.load(delay_path)
+        return dict(cell,
+                    trace_path=path,
+                    schedule=schedule.to_string(),
+                    delay_mean=float(delay.mean()),
+                    delay_p99=float(np.percentile(delay, 99)))
+
+    def shard_cell(self, cell: dict, shards: Sharding) -> dict:
+        """ returns the cell served by the nodes of shards (None keeps a single node), the shard of every list is persisted """
+        if shards is None:
+            return cell
+        ind = self.load_index(cell['dataset'], cell['index_type'])
+        sharding.get_shard_map(ind, shards, cell['nprobe'])
+        return dict(cell,
+                    sharding={
+                        'description': shards.to_string(),
+                        'n_shards': shards.n_shards,
+                        'shard_map_path': sharding.shard_map_path(ind, shards, cell['nprobe']),
+                        'device': self.device.name,
+                        'bytes_per_unit': 1 if self.units == 'bytes' else cell['bytes_per_vector'],
+                    })
+
+    def prepare_refine_cell(self, ind: Index, nprobe: int) -> dict:
+        ind.get_refine_trace(nprobe)
+        list_sizes_path = ind.sidecar_path('refine_sizes')
+        list_sizes = np.ones(ind.index.ntotal, dtype=np.int64)
+        if self.units == 'bytes':
+            list_sizes_path = ind.sidecar_path(f'refine_bytes{self.block_size}')
+            list_sizes *= ind.get_refine_bytes(self.block_size)
+        if not os.path.isfile(list_sizes_path):
+            utils.save_npy(list_sizes_path, list_sizes)
+        return {
+            'trace_path': probe_trace.refine_trace_path(ind, nprobe, ind.xq),
+            'list_sizes_path': list_sizes_path,
+            'bytes_per_vector': ind.get_refine_bytes(1),
+            'pin_plans': {},
+        }
+
+    def load_index(self, dataset: str, index_type: str, partitioning: Partitioning = None) -> Index:
+        return self.registry.get_index(dataset, index_type, partitioning)
+
+    def write_result(self, result: Result):
+        with open(self.filename, 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(result.to_row())
+
+    def run_disk(self, cell: dict, cache: Cache) -> dict:
+        """ in disk mode, runs cache against the on-disk list layout and returns the disk_store report """
+        if not self.disk_mode:
+            return None
+        ind = self.load_index(cell['dataset'], cell['index_type'])
+        if cell['schedule'] is not None or cell['probing'] != 'fixed' or cell['workload'] or cell['sharding']:
+            print("Disk search replays the fixed nprobe trace of xq in arrival order, skipping it for this cell")
+            return None
+        if not ind.is_flat():
+            print(f"Disk search only scans Flat IVF lists, skipping it for {ind.index_type}")
+            return None
+        layout = cell['layout']
+        order = np.load(layout['order_path']) if layout else None
+        return run_disk_search(ind, cache, cell['nprobe'], self.direct_io, SharedIndex(cell), layout['name'] if layout else 'id', order, self.merge_gap)
+
+    def write_cell_result(self, cell: dict, cache: Cache, counts: tuple, belady: tuple, disk: dict = None, refine: tuple = None):
+        """ writes the row of one cache of a cell, counts = (hits, misses, vectors_read[, extras]) or None if its pins didn't fit,
+            belady, disk and refine are the Belady counts of its capacity, the disk mode report and the refine cache counts, or None
+        """
+        if counts is None:
+            print(f"Skipping {cache.to_string()}, its pinned lists exceed its capacity")
+            return
+        hits, misses, vectors_read = counts[:3]
+        extras = counts[3] if len(counts) > 3 else {}
+        recall = extras.get('recall', cell['recall'])
+        belady_read = belady[2] if belady is not None else None
+        print(f"{cache.to_string()}: {hits} hits, {misses} misses, {vectors_read} {self.units} read" + (f" ({belady_read} with Belady)" if belady is not None else ''))
+        # in vectors mode the bytes are estimated without block rounding
+        nbytes = vectors_read if self.units == 'bytes' else vectors_read * cell['bytes_per_vector']
+        requests = misses
+        # misses merged into read runs on the cell's layout are costed per run
+        if 'read_runs_per_query' in extras:
+            print(f"\t{cell['layout']['name']} layout: {extras['read_runs_per_query']:.2f} read runs, {extras['merged_bytes_per_query']:.0f} bytes per query")
+            requests = extras['read_runs_per_query'] * cell['n_queries']
+            nbytes = extras['merged_bytes_per_query'] * cell['n_queries']
+        refine_hits, refine_misses, refine_read = refine[:3] if refine else (None, None, None)
+        if refine:
+            print(f"\trefine: {refine_hits} hits, {refine_misses} misses, {refine_read} {self.units} read")
+            requests += refine_misses
+            nbytes += refine_read if self.units == 'bytes' else refine_read * cell['refine']['bytes_per_vector']
+        io_seconds = self.device.io_seconds(requests, nbytes)
+        tiers = extras.get('tiers')
+        if tiers:
+            # the hierarchy's tiers serve its hits on their own devices, the misses go to self.device
+            print(f"\ttiers: {tiers['hits']} hits, {tiers['read']} {self.units} served, {tiers['filled']} {self.units} filled")
+            bytes_per_unit = 1 if self.units == 'bytes' else cell['bytes_per_vector']
+            io_seconds = io_model.tiered_io_seconds(tiers, requests, nbytes, self.device, bytes_per_unit)
+        io_ms_per_query = io_seconds / cell['n_queries'] * 1000
+        shards = extras.get('shards')
+        if shards:
+            print(f"\t{cell['sharding']['description']}: fan-out {shards['fanout_mean']:.2f}, load imbalance {shards['load_imbalance']:.2f}, "
+                  f"node hit ratios {min(shards['node_hit_ratio']):.3f}-{max(shards['node_hit_ratio']):.3f}, p99 latency {shards['latency_p99_ms']:.3f}ms")
+        pin_count = 0
+        if isinstance(cache, PinCache):
+            pin_count = cache.pincount
+            if cache.pin_budget is not None:
+                pin_count = len(SharedIndex(cell).get_pin_plan(cache.pin_budget))
+        self.write_result(Result(
+            dataset=cell['dataset'],
+            index_description=cell['index_type'],
+            index_centroids=cell['n_clusters'],
+            cache_description=cache.to_string(),
+            cache_size=cache.capacity,
+            pin_count=pin_count,
+            hits=hits,
+            misses=misses,
+            vectors_read=vectors_read,
+            num_necessary_cluster_reads=cell['u_centroids'],
+            num_necessary_vector_reads=cell['u_vectors'],
+            recall=recall,
+            nprobe=cell['nprobe'],
+            belady_vectors_read=belady_read,
+            disk_bytes_read=disk['bytes_read'] if disk else None,
+            disk_qps=disk['qps'] if disk else None,
+            latency_p50_ms=disk['latency_p50_ms'] if disk else None,
+            latency_p99_ms=disk['latency_p99_ms'] if disk else None,
+            units=self.units,
+            device=self.device.name,
+            io_ms_per_query=io_ms_per_query,
+            refine_hits=refine_hits,
+            refine_misses=refine_misses,
+            refine_read=refine_read,
+            schedule=cell['schedule'],
+            delay_mean_visits=cell['delay_mean'],
+            delay_p99_visits=cell['delay_p99'],
+            probing=cell['probing'],
+            mean_nprobe=cell['mean_nprobe'],
+            workload=cell['workload'],
+            layout=cell['layout']['name'] if cell['layout'] else None,
+            read_runs_per_query=extras.get('read_runs_per_query'),
+            merged_bytes_per_query=extras.get('merged_bytes_per_query'),
+            disk_read_requests=disk['read_requests'] if disk else None,
+            max_list_size=cell['max_list_size'],
+            tier_hits='/'.join(map(str, tiers['hits'])) if tiers else None,
+            tier_read='/'.join(map(str, tiers['read'])) if tiers else None,
+            tier_filled='/'.join(map(str, tiers['filled'])) if tiers else None,
+            sharding=cell['sharding']['description'] if cell['sharding'] else None,
+            fanout_mean=shards['fanout_mean'] if shards else None,
+            load_imbalance=shards['load_imbalance'] if shards else None,
+            shard_latency_p99_ms=shards['latency_p99_ms'] if shards else None
+            ))
+
+    def run_lru_curve(self, cell: dict, caches: list[Cache]) -> dict[int, tuple[int, int, int]]:
+        """ in lru_curve mode, returns {capacity: (hits, misses, vectors_read)} for every LRUCache in caches
+            from one stack distance pass, otherwise an empty dict
+        """
+        capacities = [x.capacity for x in caches if isinstance(x, LRUCache)]
+        if not self.lru_curve or not capacities or cell['cache_aware'] or cell['sharding']:
+            return {}
+        trace = np.load(cell['trace_path'], mmap_mode='r')
+        if cell['layout'] and trace.ndim == 2:
+            # the curve only counts misses, the layout's read runs need a replay per capacity
+            print("Misses of this cell are costed in read runs on its layout, simulating each LRU capacity")
+            return {}
+        print(f"Simulating LRU capacities {capacities} in one pass")
+        list_sizes = np.load(cell['list_sizes_path'], mmap_mode='r')
+        return lru_curve(np.asarray(trace).ravel(), list_sizes, capacities)
 
     def run_single_sim(self, 
                        dataset: str, 
-                       n_clusters: int,
+                       index_type: str | int,
                        cache: Cache,
+                       refine: Cache = None,
+                       partitioning: Partitioning = None
                        ):
-        if dataset == 'sift':
-            xt, xb, xq, gt = utils.get_sift()
-        elif dataset.startswith('glove'):
-            n_dims = dataset.split('-')[1]
-            xt, xb, xq, gt = utils.get_glove(n_dims)
-
-        ind = Index(dataset, f'IVF{n_clusters},Flat', xt, xb, xq, gt)
-        nprobe = self.find_nprobe(ind)
-        cache.reset()
-        try:
-            cache.setup(index=ind)
-            u_centroids, u_vectors = ind.simulate_cache(cache, nprobe)
-            labels = ind.search(nprobe)
-            recall = ind.report_recall(labels)
-
-            pin_count = 0
-            if isinstance(cache, PinCache):
-                pin_count = cache.pincount
-
-            result = Result(
-                dataset=dataset,
-                index_description=ind.index_type,
-                index_centroids=n_clusters,
-                cache_description=cache.to_string(),
-                cache_size=cache.capacity,
-                pin_count=pin_count,
-                hits=cache.num_hits(),
-                misses=cache.num_misses(),
-                vectors_read=cache.num_vectors_read(),
-                num_necessary_cluster_reads=u_centroids,
-                num_necessary_vector_reads=u_vectors,
-                recall=recall,
-                nprobe=nprobe
-                )
-            with open(self.filename, 'a', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(result.to_row())
-        except:
-            print("Exception occured in simulation, likely due to pincount")
-            result = Result(ind.index_type, cache.to_string(), 0, 0, 0, 0, 0, 0, 0)
-            self.results.append(result)
+        index_type = factory_string(index_type)
+        cell = self.prepare_cell(dataset, index_type, [cache], partitioning)
+        belady = simulate_cell(cell, BeladyCache(cache.capacity)) if self.belady else None
+        counts = simulate_cell(cell, cache)
+        disk = self.run_disk(cell, cache) if counts is not None else None
+        refine_counts = simulate_cell(cell['refine'], refine_cache({'refine_cache': refine})) if cell['refine'] else None
+        self.write_cell_result(cell, cache, counts, belady, disk, refine_counts)
 
     def write_results(self, filename):
         with open(filename, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow([
-                'dataset',
-                'index_description',
-                'index_centroids',
-                'cache_description',
-                'cache_size',
-                'pin_count',
-                'hits', 
-                'misses', 
-                'vectors_read', 
-                'num_necessary_cluster_reads',
-                'num_necessary_vector_reads',
-                'recall',
-                'nprobe'
-            ])
+            writer.writerow(RESULT_COLUMNS)
             result_rows = [x.to_row() for x in self.results]
             writer.writerows(result_rows)
 
     def find_nprobe(self, index: Index) -> int:
         print(f"Finding nprobe for {index.dataset} - {index.index_type}")
-        if index.dataset in self.nprobe_cache:
+        # the nprobe of a rebuilt index is found again
+        if index.dataset in self.nprobe_cache and not index.rebuilt:
             if index.index_type in self.nprobe_cache[index.dataset]:
                 nprobe = self.nprobe_cache[index.dataset][index.index_type]
                 print(f"Found nprobe={nprobe} in nprobe cache")
                 return nprobe
 
-        search_factor = 2
-        nprobe = 8
-        labels = index.search(nprobe)
-        recall = index.report_recall(labels)
-        print(f'\tnprobe={nprobe}, recall={recall}')
-        while recall <= self.recall_target:
-            nprobe *= search_factor
-            labels = index.search(nprobe)
-            recall = index.report_recall(labels)
-            print(f'\tprobe={nprobe}, recall={recall}')
-
-        # we have gone past the threshold
-        high = nprobe
-        low = nprobe // search_factor
-
-        # perform a normal binary search
-        while low < high:
-            # Calculate the middle point
-            nprobe = (low + high) // 2
-
-            # get recall for the middle point
-            labels = index.search(nprobe)
-            recall = index.report_recall(labels)
-            print(f'\tnprobe={nprobe}, recall={recall}')
-
-            if recall >= self.recall_target:
-            # met the threshold, try searching lower
-                high = nprobe
-            else:
-            # recall is too low, searching higher
-                low = nprobe
-            if high - low <= 1:
-                break
-
-        if recall < self.recall_target:
-            nprobe += 1
-            labels = index.search(nprobe)
-            recall = index.report_recall(labels)
-            print(f'\tnprobe={nprobe}, recall={recall}')
+        if index.is_flat():
+            nprobe = self.find_nprobe_by_curve(index)
+        else:
+            nprobe = self.find_nprobe_by_search(index)
         # manage our nprobe cache
         if index.dataset not in self.nprobe_cache:
             self.nprobe_cache[index.dataset] = {}
         self.nprobe_cache[index.dataset][index.index_type] = nprobe
-        return nprobe
\ No newline at end of file
+        self.save_nprobe_cache()
+        return nprobe
+
+    def find_nprobe_by_curve(self, index: Index) -> int:
+        """ grows the recall curve until it reaches the target, then takes the smallest nprobe that meets it """
+        nlist = index.index_ivf.nlist
+        max_nprobe = 64
+        curve = index.recall_curve(max_nprobe)
+        while curve[-1] < self.recall_target and max_nprobe < nlist:
+            max_nprobe *= 2
+            curve = index.recall_curve(max_nprobe)
+            print(f'\tnprobe={len(curve) - 1}, recall={curve[-1]}')
+
+        meets_target = np.flatnonzero(curve >= self.recall_target)
+        nprobe = int(meets_target[0]) if len(meets_target) else len(curve) - 1
+        print(f'\tnprobe={nprobe}, recall={curve[nprobe]}')
+        return nprobe
+
+    def find_nprobe_by_search(self, index: Index) -> int:
+        """ compressed codes have no closed-form recall curve, so this doubles nprobe with real searches
+            until the target is met and binary searches the last doubling for the smallest nprobe that meets it
+        """
+        nlist = index.index_ivf.nlist
+        low, high = 0, 1
+        recall = index.report_recall(index.search(high))
+        while recall < self.recall_target and high < nlist:
+            low, high = high, min(high * 2, nlist)
+            recall = index.report_recall(index.search(high))
+            print(f'\tnprobe={high}, recall={recall}')
+        while high - low > 1:
+            mid = (low + high) // 2
+            mid_recall = index.report_recall(index.search(mid))
+            print(f'\tnprobe={mid}, recall={mid_recall}')
+            if mid_recall >= self.recall_target:
+                high = mid
+            else:
+                low = mid
+        print(f'\tnprobe={high}')
+        return high
\ No newline at end of file
@@ -13,6 +13,14 @@ def ivecs_read(fname):
 def fvecs_read(fname):
     return ivecs_read(fname).view('float32')
 
+def save_npy(path: str, array: npt.NDArray):
+    """ writes array to path through a temporary file, so concurrent readers never see a partial file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
 def get_sift() -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
     """ Returns (xt, sb, xq, gt). Downloads dataset if doesn't already exist locally """
     dir = 'sift'
@@ -47,3 +55,11 @@ def get_glove(dims: int) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDA
         train = np.array(f['train'])
         return train, train, test, neighbors
 
+def get_dataset(dataset: str) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
+    """ Returns (xt, xb, xq, gt) for 'sift' or 'glove-<dims>' """
+    if dataset == 'sift':
+        return get_sift()
+    elif dataset.startswith('glove'):
+        n_dims = dataset.split('-')[1]
+        return get_glove(n_dims)
+    raise ValueError(f'Unknown dataset {dataset}')
@@ -0,0 +1,102 @@
+import faiss
+import hashlib
+import os
+import numpy as np
+import numpy.typing as npt
+import probe_trace
+
+class Workload():
+    """ synthetic query stream over a pool of base queries (xq or xt), generated lazily in chunks and reproducible from seed """
+
+    def __init__(self,
+                 n_queries: int = 1000000,
+                 zipf: float = 1.0,
+                 repeat_prob: float = 0.1,
+                 repeat_window: int = 1000,
+                 burst_share: float = 0.3,
+                 burst_length: int = 10000,
+                 topic_size: int = 100,
+                 noise: float = 0.01,
+                 base: str = 'xq',
+                 seed: int = 0,
+                 chunk_size: int = 10000
+                 ):
+        if base not in ('xq', 'xt'):
+            raise ValueError(f'base must be xq or xt, not {base}')
+        # each query is, in order of precedence: with repeat_prob a repeat of one of the last repeat_window queries,
+        # with burst_share one of the topic_size pool queries nearest to a hot topic changing every burst_length queries,
+        # otherwise a pool query of Zipfian popularity (exponent zipf). Fresh queries get noise times the pool's std
+        self.n_queries = n_queries
+        self.zipf = zipf
+        self.repeat_prob = repeat_prob
+        self.repeat_window = repeat_window
+        self.burst_share = burst_share
+        self.burst_length = burst_length
+        self.topic_size = topic_size
+        self.noise = noise
+        self.base = base
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def key(self) -> str:
+        """ short digest of the parameters, the random draws follow the chunks so chunk_size is one of them """
+        return hashlib.sha1(repr(sorted(vars(self).items())).encode()).hexdigest()[:12]
+
+    def stream(self, pool: npt.NDArray, normalize: bool = False):
+        """ yields (start, queries) chunks of the n_queries x d float32 stream drawn from pool,
+            normalize re-normalizes the perturbed queries (for inner product datasets)
+        """
+        rng = np.random.default_rng(self.seed)
+        pool = np.ascontiguousarray(pool, dtype=np.float32)
+        weights = 1.0 / np.arange(1, len(pool) + 1) ** self.zipf
+        popularity = np.empty(len(pool))
+        popularity[rng.permutation(len(pool))] = weights / weights.sum()
+        sigma = pool.std(axis=0) * self.noise
+        history = np.empty((0, pool.shape[1]), dtype=np.float32) # last repeat_window queries
+        hot = None
+
+        for start in range(0, self.n_queries, self.chunk_size):
+            n = min(self.chunk_size, self.n_queries - start)
+            ids = rng.choice(len(pool), size=n, p=popularity)
+            source = rng.random(n)
+            positions = np.arange(start, start + n)
+            for burst in np.unique(positions // self.burst_length).tolist():
+                if hot is None or hot[0] != burst:
+                    center = pool[rng.integers(len(pool))][None, :]
+                    _, topic = faiss.knn(center, pool, min(self.topic_size, len(pool)))
+                    hot = (burst, topic[0])
+                in_burst = (positions // self.burst_length == burst) & (source >= self.repeat_prob) & (source < self.repeat_prob + self.burst_share)
+                ids[in_burst] = rng.choice(hot[1], size=int(in_burst.sum()))
+            queries = pool[ids] + rng.normal(size=(n, pool.shape[1])).astype(np.float32) * sigma
+            if normalize:
+                faiss.normalize_L2(queries)
+
+            # repeats copy an earlier query of the stream, in order so chains of repeats resolve
+            offsets = rng.integers(1, self.repeat_window + 1, size=n)
+            queries = np.concatenate((history, queries))
+            for i in np.flatnonzero(source < self.repeat_prob).tolist():
+                j = len(history) + i
+                if j - offsets[i] >= 0:
+                    queries[j] = queries[j - offsets[i]]
+            history = queries[-self.repeat_window:]
+            yield start, queries[len(queries) - n:]
+
+    def to_string(self) -> str:
+        return (f"Workload (n_queries={self.n_queries}, zipf={self.zipf}, repeat_prob={self.repeat_prob}, "
+                f"burst_share={self.burst_share}, noise={self.noise}, base={self.base}, seed={self.seed})")
+
+def workload_trace_path(index, nprobe: int, workload: Workload) -> str:
+    return f'indexes/{index.dataset}/{index.index_type}.nprobe{nprobe}.workload{workload.key()}.trace.npy'
+
+def get_workload_trace(index, nprobe: int, workload: Workload) -> npt.NDArray:
+    """ returns the n_queries x nprobe int32 probe trace of the workload's stream over index, generated chunk by chunk
+        into a memory-mapped file and persisted like probe_trace.get_trace
+    """
+    path = workload_trace_path(index, nprobe, workload)
+    if not os.path.isfile(path):
+        print(f"Computing workload trace {path}...")
+        pool = index.xq if workload.base == 'xq' else index.xt
+        normalize = index.index_ivf.metric_type == faiss.METRIC_INNER_PRODUCT
+        probes = probe_trace.stream_probes(index, nprobe, workload.stream(pool, normalize))
+        probe_trace.save_probes(path, probes, workload.n_queries, nprobe)
+    return np.load(path, mmap_mode='r')